@@ -1,32 +1,9 @@
 from __future__ import annotations
 
 from egraph import EGraph
-from match_egraph import match_rule
 from mini_lisp.core import parse
-from mini_lisp.rules import RuleSet, parse_ruleset, trim_ruleset
-
-
-def all_match_(egraph: EGraph, rule_set: RuleSet, visualize_lvl: int =0, max_iter: int = 200) -> None:
-    iter_counter = 0
-    h = hash(egraph)
-    nh = None
-    while nh != h:
-        results = list(res for rule in rule_set for res in match_rule(egraph, rule))
-        if len(results) == 0:
-            break
-        for result in results:
-            old_h_in = hash(egraph)
-            egraph.apply_(result)
-            if hash(egraph) != old_h_in and visualize_lvl == 2:
-                egraph.to_mermaid().view_()
-        if hash(egraph) != old_h_in and visualize_lvl == 1:
-            egraph.to_mermaid().view_()
-        h = nh
-        nh = hash(egraph)
-        iter_counter += 1
-        if iter_counter > max_iter:
-            print("max_iter reached! ")
-            break
+from mini_lisp.rules import parse_ruleset, trim_ruleset
+from runner import saturate
 
 
 example = "(/ (^ (* (+ (* 0 3) 2 3) x 4) (- 2)) (- 2))"
@@ -43,7 +20,7 @@ ruleset = parse_ruleset(
 )
 print(ruleset)
 
-all_match_(egraph, ruleset, visualize_lvl=2)
+saturate(egraph, ruleset, visualize_lvl=2)
 egraph.to_mermaid().view_()
 
 example = "(^ (+ a 2) 2)"
@@ -65,4 +42,4 @@ ruleset = parse_ruleset(
     """, trim=True
 )
 # (^ x n) == (* x (^ x (- n 1)))
-all_match_(g, ruleset, visualize_lvl=1)
\ No newline at end of file
+saturate(g, ruleset, visualize_lvl=1)
\ No newline at end of file
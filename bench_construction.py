@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+import time
+from typing import Iterator
+
+from egraph import EGraph, AstP
+from mini_lisp.core import Ast
+from mini_lisp.core_types import Number, Variable
+
+OPS = [Variable(x) for x in ('+', '*', '-', '/')]
+
+
+def balanced_ast(n_leaves: int, counter: Iterator[int]) -> AstP:
+    # distinct leaves, so nothing collapses in the hashcons and the graph has 2 * n_leaves - 1 nodes
+    if n_leaves == 1:
+        return Number(next(counter))
+    left = n_leaves // 2
+    return Ast((OPS[n_leaves % len(OPS)], balanced_ast(left, counter), balanced_ast(n_leaves - left, counter)))
+
+
+def time_from_ast(ast: AstP) -> float:
+    start = time.perf_counter()
+    EGraph.from_ast(ast)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    print(f"{'nodes':>10} {'seconds':>10} {'us/node':>10}")
+    for n_leaves in (12_500, 25_000, 50_000, 100_000, 200_000):
+        ast = balanced_ast(n_leaves, iter(range(n_leaves)))
+        n_nodes = 2 * n_leaves - 1
+        elapsed = time_from_ast(ast)
+        print(f"{n_nodes:>10} {elapsed:>10.3f} {elapsed / n_nodes * 1e6:>10.2f}")
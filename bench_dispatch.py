@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import time
+from typing import Callable, List
+
+from bench_construction import balanced_ast
+from mini_lisp.core import Ast, Symbols
+from mini_lisp.core_types import AstParent, Symbol, Variable, Number
+from mini_lisp.patterns import MatchResult, match, match_tree, PartialAst
+from mini_lisp.tree_utils import tree_replace
+
+
+# Reference versions dispatching through isinstance against the runtime_checkable protocols
+def tree_replace_protocol(ast, table, key_type, dest_constructor):
+    if isinstance(ast, AstParent):
+        return dest_constructor(tuple(tree_replace_protocol(arg, table, key_type, dest_constructor)
+                                      for arg in ast.args))
+    elif isinstance(ast, key_type):
+        return table.get(ast, ast)
+    else:
+        return ast
+
+
+def match_protocol(ast, to_match) -> List[MatchResult]:
+    sym_list = []
+    if isinstance(ast, AstParent):
+        if isinstance(to_match, AstParent):
+            res = match_tree(ast, to_match)
+            if res is not None:
+                sym_list.append(MatchResult(ast, res))
+        for arg1 in ast.args:
+            sym_list += match_protocol(arg1, to_match)
+        return sym_list
+    else:
+        if isinstance(to_match, AstParent):
+            return []
+        else:
+            return [MatchResult(ast, Symbols.from_from_symbol({to_match: ast}))]
+
+
+def best_of(fn: Callable[[], object], repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    pattern = PartialAst((Variable('+'), Symbol(0), Symbol(1)))
+    table = {Number(i): Variable(f"v{i}") for i in range(0, 1 << 12, 2)}
+    print(f"{'nodes':>8} {'replace/protocol':>17} {'replace/tag':>12} {'match/protocol':>15} {'match/tag':>10}")
+    for n_leaves in (64, 256, 1024, 4096):
+        ast = balanced_ast(n_leaves, iter(range(n_leaves)))
+        assert tree_replace(ast, table, Number, Ast) == tree_replace_protocol(ast, table, Number, Ast)
+        assert match(ast, pattern) == match_protocol(ast, pattern)
+        replace_protocol = best_of(lambda: tree_replace_protocol(ast, table, Number, Ast))
+        replace_tag = best_of(lambda: tree_replace(ast, table, Number, Ast))
+        match_protocol_t = best_of(lambda: match_protocol(ast, pattern))
+        match_tag = best_of(lambda: match(ast, pattern))
+        print(f"{2 * n_leaves - 1:>8} {replace_protocol:>17.4f} {replace_tag:>12.4f} "
+              f"{match_protocol_t:>15.4f} {match_tag:>10.4f}")
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import time
+
+from egraph import EGraph
+from match_egraph import match_rule, MatchBackend
+from mini_lisp.core import parse
+from mini_lisp.rules import parse_ruleset, RuleSet
+
+w3j_example = "(* (w3j l1 l2 l3 s1 s2 s3) (w3j l2 l1 l3 s2p s1p s3p))"
+w3j_rules = parse_ruleset(
+    """
+    (w3j l1 l2 l3 s1 s2 s3) == (w3j l2 l3 l1 s2 s3 s1)
+    (w3j l1 l2 l3 s1 s2 s3) == (* P (w3j l2 l1 l3 s2 s1 s3))
+    (* (w3j l1 l2 l3 s1 s2 s3) (w3j l1 l2 l3 s1p s2p s3p)) == (* (wigd l1 s1 s1p) (wigd l2 s2 s2p) (wigd l3 s3 s3p))
+    (* (* a b) c) == (* a (* b c))
+    (* a b) == (* b a)
+    """,
+    custom_ops=['w3j', 'P', 'wigd'], trim=True
+)
+
+
+def grow_(egraph: EGraph, rule_set: RuleSet) -> None:
+    # one saturation iteration
+    for result in [res for rule in rule_set for res in match_rule(egraph, rule)]:
+        egraph.apply_(result)
+    egraph.rebuild()
+
+
+def time_match(egraph: EGraph, rule_set: RuleSet, backend: MatchBackend, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for rule in rule_set:
+            match_rule(egraph, rule, backend)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    g = EGraph.from_ast(parse(w3j_example))
+    for _ in range(4):
+        grow_(g, w3j_rules)
+        for rule in w3j_rules:
+            assert match_rule(g, rule, "recursive") == match_rule(g, rule, "compiled")
+        n_nodes = sum(len(v) for v in g.classes.values())
+        recursive = time_match(g, w3j_rules, "recursive")
+        compiled = time_match(g, w3j_rules, "compiled")
+        print(f"nodes: {n_nodes:>6}  recursive: {recursive:.3f}s  compiled: {compiled:.3f}s  "
+              f"speedup: {recursive / compiled:.2f}x")
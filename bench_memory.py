@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import time
+import tracemalloc
+from typing import Callable, Tuple, Type
+
+from bench_construction import balanced_ast
+from compact_egraph import CompactEGraph
+from egraph import EGraph
+from mini_lisp.core import parse
+from mini_lisp.rules import parse_ruleset
+from runner import Runner
+
+ruleset = parse_ruleset(
+    """
+    (+ x y) == (+ y x)
+    (+ x (+ y z)) == (+ (+ x y) z)
+    (* x (+ y z)) == (+ (* x y) (* x z))
+    """, trim=True
+)
+
+
+def measure(build: Callable[[Type[EGraph]], EGraph], cls: Type[EGraph]) -> Tuple[EGraph, int, float]:
+    # bytes still allocated once the graph is built, the input Ast is built before tracing starts
+    tracemalloc.start()
+    start = time.perf_counter()
+    g = build(cls)
+    seconds = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return g, size, seconds
+
+
+def tree(n_leaves: int) -> Callable[[Type[EGraph]], EGraph]:
+    ast = balanced_ast(n_leaves, iter(range(n_leaves)))
+    return lambda cls: cls.from_ast(ast)
+
+
+def saturate(cls: Type[EGraph]) -> EGraph:
+    # every grouping of a sum of 7 terms, many nodes per class
+    g = cls.from_ast(parse("(+ a (+ b (+ c (+ d (+ e (+ f g))))))"))
+    Runner(g, iter_limit=8, node_limit=20_000, time_limit=None).run(ruleset)
+    return g
+
+
+if __name__ == "__main__":
+    print(f"{'workload':>12} {'nodes':>8} {'classes':>8} {'EGraph B/node':>14} {'compact B/node':>15} "
+          f"{'ratio':>6} {'EGraph s':>9} {'compact s':>10}")
+    workloads = [(f"tree {n_leaves}", tree(n_leaves)) for n_leaves in (10_000, 50_000, 200_000)]
+    workloads.append(("saturated", saturate))
+    for name, build in workloads:
+        g, size, seconds = measure(build, EGraph)
+        compact, compact_size, compact_seconds = measure(build, CompactEGraph)
+        assert compact.n_nodes == g.n_nodes and hash(compact) == hash(g)
+        print(f"{name:>12} {g.n_nodes:>8} {len(g.classes):>8} {size / g.n_nodes:>14.1f} "
+              f"{compact_size / g.n_nodes:>15.1f} {size / compact_size:>5.2f}x {seconds:>9.3f} {compact_seconds:>10.3f}")
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import os
+import time
+
+from bench_relational import w3j_classes, nonlinear_rules
+from egraph import EGraph
+from match_egraph import match_symbols
+from parallel_match import ParallelMatcher
+
+
+def serial_search(egraph: EGraph) -> float:
+    start = time.perf_counter()
+    for rule in nonlinear_rules:
+        list(match_symbols(egraph, rule, "compiled"))
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    # the top down matcher tries class_size ** 2 pairs per product, so matching dominates the snapshot cost.
+    # Parallel times include saving the snapshot and every worker mapping it
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'class size':>10} {'nodes':>7} {'serial':>8} {'processes':>10} {'parallel':>9} {'speedup':>8}")
+    for class_size in (20, 40, 80):
+        g = w3j_classes(20, class_size, n_labels=8)
+        serial = serial_search(g)
+        for processes in (1, 2, 4):
+            with ParallelMatcher(nonlinear_rules, processes=processes, n_shards=4 * processes) as parallel:
+                # spawn the workers before timing
+                parallel.search(w3j_classes(1, 1, n_labels=8), nonlinear_rules)
+                start = time.perf_counter()
+                parallel.search(g, nonlinear_rules)
+                seconds = time.perf_counter() - start
+            print(f"{class_size:>10} {g.n_nodes:>7} {serial:>8.3f} {processes:>10} {seconds:>9.3f} "
+                  f"{serial / seconds:>7.2f}x")
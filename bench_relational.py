@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import random
+
+from bench_ematch import time_match
+from egraph import EGraph, ClassRef
+from match_egraph import match_rule
+from mini_lisp.core import Ast
+from mini_lisp.core_types import Variable
+from mini_lisp.rules import parse_ruleset
+
+# non-linear: both sides of the product must agree on l1 l2 l3
+nonlinear_rules = parse_ruleset(
+    """
+    (* (w3j l1 l2 l3 s1 s2 s3) (w3j l1 l2 l3 s1p s2p s3p)) -> (* (wigd l1 s1 s1p) (wigd l2 s2 s2p) (wigd l3 s3 s3p))
+    (* (wigd l s sp) (wigd l sp spp)) -> (wigd l s spp)
+    """,
+    custom_ops=['w3j', 'wigd']
+)
+
+
+def w3j_classes(n_classes: int, class_size: int, n_labels: int, seed: int = 0) -> EGraph:
+    # n_classes products of two classes holding class_size w3j terms each, labels drawn from n_labels,
+    # so a top down matcher tries class_size ** 2 pairs per product while few agree on the labels
+    rng = random.Random(seed)
+    g = EGraph.empty()
+
+    def w3j_class() -> int:
+        class_id = None
+        for _ in range(class_size):
+            l1, l2, l3 = (rng.randrange(n_labels) for _ in range(3))
+            s1, s2, s3 = (rng.randrange(n_labels) for _ in range(3))
+            term = g.add_expr(f"(w3j l{l1} l{l2} l{l3} s{s1} s{s2} s{s3})")
+            class_id = term if class_id is None else g.merge_class_(class_id, term)
+        return class_id
+
+    for _ in range(n_classes):
+        g.add_expr(Ast((Variable('*'), ClassRef(w3j_class()), ClassRef(w3j_class()))))
+    g.rebuild()
+    return g
+
+
+if __name__ == "__main__":
+    print(f"{'class size':>10} {'nodes':>7} {'matches':>8} {'compiled':>9} {'relational':>11} {'speedup':>8}")
+    for class_size in (5, 10, 20, 40, 80):
+        g = w3j_classes(20, class_size, n_labels=8)
+        for rule in nonlinear_rules:
+            assert match_rule(g, rule, "compiled") == match_rule(g, rule, "relational")
+        n_matches = sum(len(match_rule(g, rule)) for rule in nonlinear_rules)
+        compiled = time_match(g, nonlinear_rules, "compiled")
+        relational = time_match(g, nonlinear_rules, "relational")
+        print(f"{class_size:>10} {g.n_nodes:>7} {n_matches:>8} {compiled:>9.4f} {relational:>11.4f} "
+              f"{compiled / relational:>7.2f}x")
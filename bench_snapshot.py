@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import os
+import pickle
+import tempfile
+import time
+
+from bench_construction import balanced_ast
+from compact_egraph import CompactEGraph
+from egraph import EGraph, ENode
+from snapshot import EGraphSnapshot, SnapshotGraph
+
+if __name__ == "__main__":
+    print(f"{'nodes':>10} {'MB':>7} {'pickle MB':>10} {'save':>7} {'load':>7} {'compact load':>13} {'open':>7} "
+          f"{'pickle load':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "graph.egraph")
+        for n_leaves in (25_000, 100_000, 400_000):
+            g = EGraph.from_ast(balanced_ast(n_leaves, iter(range(n_leaves))))
+            start = time.perf_counter()
+            g.save(path)
+            save_time = time.perf_counter() - start
+            start = time.perf_counter()
+            EGraph.load(path)
+            load_time = time.perf_counter() - start
+            start = time.perf_counter()
+            CompactEGraph.load(path)
+            compact_time = time.perf_counter() - start
+            # open the mapped view and look up the root node and a leaf, as a query would
+            start = time.perf_counter()
+            with EGraphSnapshot.open(path) as snapshot:
+                view = SnapshotGraph(snapshot)
+                assert all(view.lookup(node) == view.root_class for node in view.classes[view.root_class])
+                assert view.lookup(ENode(balanced_ast(1, iter([0])))) is not None
+            open_time = time.perf_counter() - start
+            pickled = pickle.dumps(g)
+            start = time.perf_counter()
+            pickle.loads(pickled)
+            pickle_time = time.perf_counter() - start
+            print(f"{g.n_nodes:>10} {os.path.getsize(path) / 1e6:>7.2f} {len(pickled) / 1e6:>10.2f} "
+                  f"{save_time:>7.3f} {load_time:>7.3f} {compact_time:>13.3f} {open_time:>7.4f} {pickle_time:>12.3f}")
@@ -0,0 +1,480 @@
+from __future__ import annotations
+
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Dict, List, Set, Optional, Tuple, Iterator, FrozenSet, Iterable
+
+from egraph import EGraph, ENode
+from mini_lisp.core import RawLeaves
+
+# hashcons slots hold node id + 1
+EMPTY = 0
+DELETED = -1
+# end of a chain
+NONE = -1
+
+
+class ArrayUnionFind:
+    # UnionFind over two int columns, index 0 is unused so class ids index them directly
+    __slots__ = ("parents", "sizes")
+
+    def __init__(self):
+        self.parents = array("i", [0])
+        self.sizes = array("i", [0])
+
+    @property
+    def n_ids(self) -> int:
+        return len(self.parents) - 1
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ArrayUnionFind) and self.parents == other.parents and self.sizes == other.sizes
+
+    def make_set_(self) -> int:
+        i = len(self.parents)
+        self.parents.append(i)
+        self.sizes.append(1)
+        return i
+
+    def find(self, i: int) -> int:
+        parents = self.parents
+        root = i
+        while parents[root] != root:
+            root = parents[root]
+        # path compression
+        while parents[i] != root:
+            parents[i], i = root, parents[i]
+        return root
+
+    def union_(self, a: int, b: int) -> int:
+        # union by size, returns the new root
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.sizes[a] < self.sizes[b]:
+            a, b = b, a
+        self.parents[b] = a
+        self.sizes[a] += self.sizes[b]
+        return a
+
+
+class EClassTable:
+    # The e-class records as columns indexed by class id (index 0 is unused), rows of merged ids are cleared.
+    # Members of a class are chained through next_node by node id, from first_node to last_node.
+    # The nodes using a class as a child are chained through use slots: use_nodes holds the node id,
+    # next_use the next slot, from first_use to last_use. A merge splices both chains in O(1),
+    # slots freed by a repair are chained from free_use and reused
+    __slots__ = ("first_node", "last_node", "next_node", "first_use", "last_use", "use_nodes", "next_use",
+                 "free_use")
+
+    def __init__(self):
+        self.first_node = array("i", [NONE])
+        self.last_node = array("i", [NONE])
+        self.next_node = array("i")
+        self.first_use = array("i", [NONE])
+        self.last_use = array("i", [NONE])
+        self.use_nodes = array("i")
+        self.next_use = array("i")
+        self.free_use = NONE
+
+    def add_(self, node_id: int) -> None:
+        # a new class holding only node_id, whose id is the next row
+        self.first_node.append(node_id)
+        self.last_node.append(node_id)
+        self.next_node.append(NONE)
+        self.first_use.append(NONE)
+        self.last_use.append(NONE)
+
+    def members(self, class_id: int) -> Iterator[int]:
+        node_id = self.first_node[class_id]
+        while node_id != NONE:
+            yield node_id
+            node_id = self.next_node[node_id]
+
+    def uses(self, class_id: int) -> Iterator[int]:
+        use = self.first_use[class_id]
+        while use != NONE:
+            yield self.use_nodes[use]
+            use = self.next_use[use]
+
+    def add_use_(self, class_id: int, node_id: int) -> None:
+        if self.free_use == NONE:
+            use = len(self.use_nodes)
+            self.use_nodes.append(node_id)
+            self.next_use.append(NONE)
+        else:
+            use, self.free_use = self.free_use, self.next_use[self.free_use]
+            self.use_nodes[use], self.next_use[use] = node_id, NONE
+        if self.last_use[class_id] == NONE:
+            self.first_use[class_id] = use
+        else:
+            self.next_use[self.last_use[class_id]] = use
+        self.last_use[class_id] = use
+
+    def take_uses_(self, class_id: int) -> List[int]:
+        # empties the use chain of the class and frees its slots
+        node_ids = list(self.uses(class_id))
+        if self.first_use[class_id] != NONE:
+            self.next_use[self.last_use[class_id]] = self.free_use
+            self.free_use = self.first_use[class_id]
+        self.first_use[class_id] = self.last_use[class_id] = NONE
+        return node_ids
+
+    def splice_(self, root: int, merged: int) -> None:
+        # appends the chains of merged to the ones of root, every class holds a node
+        self.next_node[self.last_node[root]] = self.first_node[merged]
+        self.last_node[root] = self.last_node[merged]
+        if self.first_use[merged] != NONE:
+            if self.last_use[root] == NONE:
+                self.first_use[root] = self.first_use[merged]
+            else:
+                self.next_use[self.last_use[root]] = self.first_use[merged]
+            self.last_use[root] = self.last_use[merged]
+        self.first_node[merged] = self.last_node[merged] = NONE
+        self.first_use[merged] = self.last_use[merged] = NONE
+
+    def set_members_(self, class_id: int, node_ids: List[int]) -> None:
+        for a, b in zip(node_ids, node_ids[1:]):
+            self.next_node[a] = b
+        self.next_node[node_ids[-1]] = NONE
+        self.first_node[class_id], self.last_node[class_id] = node_ids[0], node_ids[-1]
+
+
+class NodeTable:
+    # Every e-node ever attached as columns: node i has op ops[node_ops[i]] (ops are interned)
+    # and children children[child_offsets[i]:child_offsets[i + 1]], rebuild rewrites them in place.
+    # The hashcons is open addressing with linear probing over node ids, alive marks the nodes it holds,
+    # congruent duplicates dropped by rebuild stay in the columns but are no longer alive
+    __slots__ = ("ops", "op_ids", "node_ops", "child_offsets", "children", "node_classes", "alive",
+                 "slots", "n_live", "n_filled")
+
+    def __init__(self):
+        self.ops: List[RawLeaves] = []
+        self.op_ids: Dict[RawLeaves, int] = {}
+        self.node_ops = array("i")
+        self.child_offsets = array("i", [0])
+        self.children = array("i")
+        # ids may be stale and need to go through find
+        self.node_classes = array("i")
+        self.alive = bytearray()
+        self.slots = array("i", [EMPTY]) * 8
+        self.n_live = 0
+        # live and deleted slots, the table grows when half of it is filled
+        self.n_filled = 0
+
+    def __len__(self) -> int:
+        return len(self.node_ops)
+
+    def op_id_(self, op: RawLeaves) -> int:
+        op_id = self.op_ids.get(op)
+        if op_id is None:
+            op_id = self.op_ids[op] = len(self.ops)
+            self.ops.append(op)
+        return op_id
+
+    def args(self, node_id: int) -> Tuple[int, ...]:
+        return tuple(self.children[self.child_offsets[node_id]:self.child_offsets[node_id + 1]])
+
+    def node(self, node_id: int) -> ENode:
+        return ENode(self.ops[self.node_ops[node_id]], self.args(node_id))
+
+    def find_id(self, op_id: int, args: Tuple[int, ...]) -> Optional[int]:
+        slots, mask = self.slots, len(self.slots) - 1
+        i = hash((op_id, args)) & mask
+        while slots[i] != EMPTY:
+            node_id = slots[i] - 1
+            if node_id >= 0 and self.node_ops[node_id] == op_id and self.args(node_id) == args:
+                return node_id
+            i = (i + 1) & mask
+        return None
+
+    def lookup(self, node: ENode) -> Optional[int]:
+        op_id = self.op_ids.get(node.op)
+        return None if op_id is None else self.find_id(op_id, node.args)
+
+    def place_(self, node_id: int) -> None:
+        slots, mask = self.slots, len(self.slots) - 1
+        i = hash((self.node_ops[node_id], self.args(node_id))) & mask
+        while slots[i] > 0:
+            i = (i + 1) & mask
+        if slots[i] == EMPTY:
+            self.n_filled += 1
+        slots[i] = node_id + 1
+
+    def insert_(self, node_id: int) -> None:
+        # the table must not hold a node equal to it, except during a repair
+        if 2 * (self.n_filled + 1) > len(self.slots):
+            self.resize_()
+        self.place_(node_id)
+        self.alive[node_id] = 1
+        self.n_live += 1
+
+    def remove_(self, node_id: int) -> None:
+        if not self.alive[node_id]:
+            return
+        slots, mask = self.slots, len(self.slots) - 1
+        i = hash((self.node_ops[node_id], self.args(node_id))) & mask
+        while slots[i] != node_id + 1:
+            i = (i + 1) & mask
+        slots[i] = DELETED
+        self.alive[node_id] = 0
+        self.n_live -= 1
+
+    def resize_(self) -> None:
+        # rehash the live nodes, which also clears deleted slots
+        size = 8
+        while size < 4 * (self.n_live + 1):
+            size *= 2
+        live = [s - 1 for s in self.slots if s > 0]
+        self.slots = array("i", [EMPTY]) * size
+        self.n_filled = 0
+        for node_id in live:
+            self.place_(node_id)
+
+    def fill_(self, key_hashes: Iterable[int]) -> None:
+        # hashcons of columns set directly, every node is live and distinct,
+        # key_hashes holds hash((node_ops[i], args(i))) of every node i in order
+        n_nodes = len(self.node_ops)
+        size = 8
+        while size < 4 * (n_nodes + 1):
+            size *= 2
+        slots, mask = array("i", [EMPTY]) * size, size - 1
+        for node_id, key_hash in enumerate(key_hashes):
+            i = key_hash & mask
+            while slots[i] != EMPTY:
+                i = (i + 1) & mask
+            slots[i] = node_id + 1
+        self.slots = slots
+        self.alive = bytearray([1]) * n_nodes
+        self.n_live = self.n_filled = n_nodes
+
+    def add_(self, op_id: int, args: Tuple[int, ...], class_id: int) -> int:
+        node_id = len(self.node_ops)
+        self.node_ops.append(op_id)
+        self.children.extend(args)
+        self.child_offsets.append(len(self.children))
+        self.node_classes.append(class_id)
+        self.alive.append(0)
+        self.insert_(node_id)
+        return node_id
+
+    def set_args_(self, node_id: int, args: Tuple[int, ...]) -> None:
+        start = self.child_offsets[node_id]
+        self.children[start:start + len(args)] = array("i", args)
+
+    def live_ids(self) -> Iterator[int]:
+        return (s - 1 for s in self.slots if s > 0)
+
+
+class ClassesView(Mapping):
+    # canonical id -> nodes of the class, built on access, ids in creation order like EGraph.classes
+    def __init__(self, graph: CompactEGraph):
+        self.graph = graph
+
+    def __getitem__(self, class_id: int) -> FrozenSet[ENode]:
+        if class_id not in self:
+            raise KeyError(class_id)
+        return frozenset(map(self.graph.table.node, self.graph.eclasses.members(class_id)))
+
+    def __contains__(self, class_id) -> bool:
+        parents = self.graph.uf.parents
+        return isinstance(class_id, int) and 0 < class_id < len(parents) and parents[class_id] == class_id
+
+    def __iter__(self) -> Iterator[int]:
+        parents = self.graph.uf.parents
+        return (i for i in range(1, len(parents)) if parents[i] == i)
+
+    def __len__(self) -> int:
+        return self.graph.n_classes
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class RegistryView(Mapping):
+    # hashcons, node -> class, ids may be stale and need to go through find
+    def __init__(self, graph: CompactEGraph):
+        self.graph = graph
+
+    def __getitem__(self, node: ENode) -> int:
+        node_id = self.graph.table.lookup(node)
+        if node_id is None:
+            raise KeyError(node)
+        return self.graph.table.node_classes[node_id]
+
+    def __iter__(self) -> Iterator[ENode]:
+        return map(self.graph.table.node, self.graph.table.live_ids())
+
+    def __len__(self) -> int:
+        return self.graph.table.n_live
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class NodesView(Sequence):
+    # node id -> node, for the ids in parent lists
+    def __init__(self, table: NodeTable):
+        self.table = table
+
+    def __getitem__(self, node_id: int) -> ENode:
+        return self.table.node(node_id)
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Sequence) and list(self) == list(other)
+
+
+class ParentsView(Mapping):
+    # canonical id -> ids of the nodes using the class as a child
+    def __init__(self, graph: CompactEGraph):
+        self.graph = graph
+
+    def __getitem__(self, class_id: int) -> array:
+        if class_id not in self.graph.classes:
+            raise KeyError(class_id)
+        return array("i", self.graph.eclasses.uses(class_id))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.graph.classes)
+
+    def __len__(self) -> int:
+        return self.graph.n_classes
+
+
+class CompactEGraph(EGraph):
+    # EGraph storing its nodes in a NodeTable and its classes in an EClassTable, a few ints per node
+    # instead of a NamedTuple, a hashcons entry, a set per class and a list of parents.
+    # classes, registry, nodes and parents are read only views with the same interface as EGraph's dicts,
+    # so matching, equality checks, extraction, snapshots and to_mermaid work on either graph,
+    # and the same operations leave both graphs with the same class ids and fingerprint.
+    # op_index only holds operators of arity > 0, usually few keys instead of one per distinct leaf
+    def __init__(self):
+        # every EGraph field is set here or is one of the views below, EGraph.__init__ would assign the views
+        self.table = NodeTable()
+        self.eclasses = EClassTable()
+        self.uf = ArrayUnionFind()
+        self.n_classes = 0
+        self.root_class: Optional[int] = None
+        self.roots: List[int] = []
+        self.pending: List[int] = []
+        self.op_index: Dict[Tuple[RawLeaves, int], Set[int]] = {}
+        self.version = 0
+        self.fingerprint = 0
+        self.dirty: Set[int] = set()
+
+    def __repr__(self) -> str:
+        return f"CompactEGraph(n_nodes={self.n_nodes}, n_classes={self.n_classes})"
+
+    @classmethod
+    def empty(cls) -> CompactEGraph:
+        return cls()
+
+    @property
+    def classes(self) -> ClassesView:
+        return ClassesView(self)
+
+    @property
+    def registry(self) -> RegistryView:
+        return RegistryView(self)
+
+    @property
+    def nodes(self) -> NodesView:
+        return NodesView(self.table)
+
+    @property
+    def node_classes(self) -> array:
+        return self.table.node_classes
+
+    @property
+    def parents(self) -> ParentsView:
+        return ParentsView(self)
+
+    @property
+    def n_nodes(self) -> int:
+        return self.table.n_live
+
+    def lookup(self, node: ENode) -> Optional[int]:
+        node_id = self.table.lookup(self.canonicalize(node))
+        return None if node_id is None else self.uf.find(self.table.node_classes[node_id])
+
+    def classes_with_op(self, op: RawLeaves, arity: int) -> Set[int]:
+        # leaves are not in op_index, a leaf is in at most one class and the hashcons finds it
+        if arity == 0:
+            class_id = self.lookup(ENode(op))
+            return set() if class_id is None else {class_id}
+        return super().classes_with_op(op, arity)
+
+    def attach_ast_node_(self, node: ENode) -> int:
+        node = self.canonicalize(node)
+        op_id = self.table.op_id_(node.op)
+        node_id = self.table.find_id(op_id, node.args)
+        if node_id is not None:
+            return self.uf.find(self.table.node_classes[node_id])
+        new_class_id = self.uf.make_set_()
+        self.n_classes += 1
+        node_id = self.table.add_(op_id, node.args, new_class_id)
+        self.eclasses.add_(node_id)
+        for arg in dict.fromkeys(node.args):
+            self.eclasses.add_use_(arg, node_id)
+        if len(node.args) > 0:
+            self.op_index.setdefault((node.op, len(node.args)), set()).add(new_class_id)
+        self.dirty.add(new_class_id)
+        self.touch_(node)
+        return new_class_id
+
+    def merge_class_(self, from_class_id: int, to_class_id: int) -> int:
+        # the hashcons is left untouched, congruence is restored by rebuild
+        from_class_id, to_class_id = self.find(from_class_id), self.find(to_class_id)
+        if from_class_id == to_class_id:
+            return from_class_id
+        new_root = self.uf.union_(from_class_id, to_class_id)
+        merged_id = to_class_id if new_root == from_class_id else from_class_id
+        self.eclasses.splice_(new_root, merged_id)
+        self.n_classes -= 1
+        self.pending.append(new_root)
+        self.dirty.add(new_root)
+        self.touch_((from_class_id, to_class_id))
+        return new_root
+
+    def repair_(self, class_id: int) -> Set[int]:
+        # same order of merges as EGraph.repair_, children of the parents are canonicalized in place.
+        # A parent equal to one already repaired merges into its class and is dropped from the hashcons,
+        # an equal parent not repaired yet can briefly share the key, removal goes by node id
+        table = self.table
+        new_parents: Dict[Tuple[int, Tuple[int, ...]], int] = {}
+        for node_id in dict.fromkeys(self.eclasses.take_uses_(class_id)):
+            if not table.alive[node_id]:
+                # dropped by an earlier repair
+                continue
+            table.remove_(node_id)
+            args = tuple(self.uf.find(a) for a in table.args(node_id))
+            table.set_args_(node_id, args)
+            key = (table.node_ops[node_id], args)
+            kept = new_parents.get(key)
+            if kept is None:
+                kept = new_parents[key] = node_id
+                table.insert_(node_id)
+            else:
+                self.merge_class_(table.node_classes[kept], table.node_classes[node_id])
+            table.node_classes[kept] = self.find(table.node_classes[kept])
+        root = self.find(class_id)
+        for node_id in new_parents.values():
+            self.eclasses.add_use_(root, node_id)
+        return {self.find(table.node_classes[n]) for n in new_parents.values()}
+
+    def rebuild(self) -> None:
+        touched: Set[int] = set()
+        while len(self.pending) > 0:
+            todo = {self.find(c) for c in self.pending}
+            self.pending = []
+            for class_id in todo:
+                touched |= self.repair_(self.find(class_id))
+        # unlink the members dropped from the hashcons
+        alive = self.table.alive
+        for class_id in {self.find(c) for c in touched}:
+            members = list(self.eclasses.members(class_id))
+            live = [n for n in members if alive[n]]
+            if len(live) < len(members):
+                self.eclasses.set_members_(class_id, live)
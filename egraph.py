@@ -1,120 +1,377 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Dict, Set, Optional
+from array import array
+from dataclasses import dataclass, field
+from typing import Dict, Set, Optional, NamedTuple, Tuple, List, Literal, Union, Iterable
 
 from graph_visualization import MermaidGraph, NodeStyle, Linkable, Link, LinkableType
-from mini_lisp.core import RawLeaves
-from mini_lisp.core_types import AstNode, Number, AstParent, Variable
-from mini_lisp.rules import RuleMatchResult, OPs
+from mini_lisp.core import RawLeaves, Symbols, parse, read_exprs, scan_lines
+from mini_lisp.core_types import AstNode, Symbol
+from mini_lisp.pattern_program import RhsTemplate
+from mini_lisp.rules import RuleMatchResult, RuleMatch
 from utils.misc import get_rounded_num
 
 AstP = AstNode[RawLeaves]
+FINGERPRINT_MASK = (1 << 64) - 1
+
+
+class ClassRef(NamedTuple):
+    # A leaf standing for a whole e-class, used to bind pattern symbols and
+    # to splice existing classes into an Ast before it is attached
+    id: int
+    type: Literal["class_ref"] = "class_ref"
+
+    @property
+    def display(self) -> str:
+        return get_rounded_num(self.id)
+
+
+class ENode(NamedTuple):
+    # op: head of the Ast (or the leaf itself), args: class ids of the children
+    op: RawLeaves
+    args: Tuple[int, ...] = ()
+
+    @property
+    def display(self) -> str:
+        if len(self.args) == 0:
+            return self.op.display
+        else:
+            return f"({self.op.display} {' '.join(get_rounded_num(a).strip() for a in self.args)})"
+
+
+@dataclass
+class UnionFind:
+    # parents: id -> parent id, roots point to themselves
+    # sizes: root id -> number of ids in its set
+    parents: Dict[int, int] = field(default_factory=dict)
+    sizes: Dict[int, int] = field(default_factory=dict)
+
+    def make_set_(self) -> int:
+        # ids are never removed, so the next fresh id is always len + 1
+        i = len(self.parents) + 1
+        self.parents[i] = i
+        self.sizes[i] = 1
+        return i
+
+    @property
+    def n_ids(self) -> int:
+        return len(self.parents)
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parents[root] != root:
+            root = self.parents[root]
+        # path compression
+        while self.parents[i] != root:
+            self.parents[i], i = root, self.parents[i]
+        return root
+
+    def union_(self, a: int, b: int) -> int:
+        # union by size, returns the new root
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.sizes[a] < self.sizes[b]:
+            a, b = b, a
+        self.parents[b] = a
+        self.sizes[a] += self.sizes.pop(b)
+        return a
 
 
 @dataclass
 class EGraph:
-    # classes are represented by ID, which nodes are represented by AST
-    # classes: id -> set of nodes in a class
-    # registry: nodes belongs to which classes
-    classes: Dict[int, Set[AstP]]
-    registry: Dict[AstP, int]
+    # classes are represented by ID, nodes are ENodes whose children are class IDs
+    # classes: canonical id -> set of nodes in a class
+    # roots: class of every added expression in order, ids may be stale and need to go through find
+    # root_class: class of the first expression
+    # registry: hashcons, node -> class, ids may be stale and need to go through find
+    # uf: union find over all class ids ever allocated
+    # nodes: node id -> the node's hashcons key, node ids index every node ever attached
+    # node_classes: node id -> class of the node, ids may be stale and need to go through find
+    # parents: canonical id -> ids of the nodes using the class as a child, deduplicated by rebuild
+    # pending: classes merged since the last rebuild, their parents need repair
+    # op_index: (op, arity) -> ids of classes holding such a node, ids may be stale and need to go through find
+    # version: bumped on every new node and every effective merge
+    # fingerprint: additive hash of every new node and every merge, kept up to date incrementally
+    #   built from hash() of interned nodes, so it only means something within one process
+    # dirty: classes created or merged since the last take_dirty_, ids may be stale and need to go through find
+    classes: Dict[int, Set[ENode]]
+    registry: Dict[ENode, int]
     root_class: Optional[int] = None
+    roots: List[int] = field(default_factory=list)
+    uf: UnionFind = field(default_factory=UnionFind)
+    nodes: List[ENode] = field(default_factory=list)
+    node_classes: array = field(default_factory=lambda: array("i"))
+    parents: Dict[int, array] = field(default_factory=dict)
+    pending: List[int] = field(default_factory=list)
+    op_index: Dict[Tuple[RawLeaves, int], Set[int]] = field(default_factory=dict)
+    version: int = 0
+    fingerprint: int = 0
+    dirty: Set[int] = field(default_factory=set)
 
     def __hash__(self):
-        return hash(tuple((k, hash(frozenset(v))) for k, v in self.classes.items()))
+        # O(1), the graph only grows so the change history identifies its state
+        return self.fingerprint
+
+    def touch_(self, change: Tuple) -> None:
+        self.version += 1
+        self.fingerprint = (self.fingerprint + hash(change)) & FINGERPRINT_MASK
 
     @property
-    def root_nodes(self) -> Set[AstP]:
+    def root_nodes(self) -> Set[ENode]:
         if self.root_class is None:
             raise RuntimeError("Graph not initialized: Root class is not set")
         else:
-            return self.classes[self.root_class].copy()
+            return self.classes[self.find(self.root_class)].copy()
+
+    @property
+    def n_nodes(self) -> int:
+        # rebuild re-keys the hashcons, so it holds one entry per distinct e-node
+        return len(self.registry)
+
+    def find(self, class_id: int) -> int:
+        return self.uf.find(class_id)
 
-    def attach_ast_node_(self, ast: AstP) -> None:
-        if ast not in self.registry:
-            # TODO this is not efficient
-            new_class_id = max(self.classes.keys(), default=0) + 1
-            self.registry[ast] = new_class_id
-            self.classes[new_class_id] = {ast}
+    def canonicalize(self, node: ENode) -> ENode:
+        return ENode(node.op, tuple(self.uf.find(a) for a in node.args))
+
+    def class_of(self, node: ENode) -> int:
+        return self.uf.find(self.registry[self.canonicalize(node)])
+
+    def lookup(self, node: ENode) -> Optional[int]:
+        class_id = self.registry.get(self.canonicalize(node))
+        return None if class_id is None else self.uf.find(class_id)
+
+    def attach_ast_node_(self, node: ENode) -> int:
+        node = self.canonicalize(node)
+        if node in self.registry:
+            return self.uf.find(self.registry[node])
+        new_class_id = self.uf.make_set_()
+        self.registry[node] = new_class_id
+        self.classes[new_class_id] = {node}
+        node_id = len(self.nodes)
+        self.nodes.append(node)
+        self.node_classes.append(new_class_id)
+        self.parents[new_class_id] = array("i")
+        for arg in dict.fromkeys(node.args):
+            self.parents[arg].append(node_id)
+        self.op_index.setdefault((node.op, len(node.args)), set()).add(new_class_id)
+        self.dirty.add(new_class_id)
+        self.touch_(node)
+        return new_class_id
+
+    def parent_nodes(self, class_id: int) -> List[Tuple[ENode, int]]:
+        # (node, canonical class) of every node using the class as a child
+        return [(self.nodes[n], self.find(self.node_classes[n])) for n in self.parents[self.find(class_id)]]
+
+    def take_dirty_(self) -> Set[int]:
+        dirty, self.dirty = {self.find(c) for c in self.dirty}, set()
+        return dirty
+
+    def ancestors(self, class_ids: Set[int], depth: int) -> Set[int]:
+        # the classes and every class reaching one of them through at most depth parent links
+        found = {self.find(c) for c in class_ids}
+        frontier = found
+        for _ in range(depth):
+            frontier = {self.find(self.node_classes[n]) for c in frontier for n in self.parents[c]} - found
+            if len(frontier) == 0:
+                break
+            found |= frontier
+        return found
+
+    def classes_with_op(self, op: RawLeaves, arity: int) -> Set[int]:
+        # merges leave stale ids behind, compact them on read
+        class_ids = {self.uf.find(c) for c in self.op_index.get((op, arity), ())}
+        if len(class_ids) > 0:
+            self.op_index[(op, arity)] = class_ids
+        return class_ids
 
     @staticmethod
-    def attach_ast_(ast: AstP, egraph: EGraph) -> None:
-        if isinstance(ast, Number) or isinstance(ast, Variable):
-            egraph.attach_ast_node_(ast)
-        else:
-            if not isinstance(ast, AstParent):
-                raise Exception(f"Ast {ast} has unexpected type: {type(ast)}")
-            for arg in ast.args:
-                EGraph.attach_ast_(arg, egraph)
-            egraph.attach_ast_node_(ast)
-            # egraph.class_links[egraph.registry[ast]] = tuple(egraph.registry[a] for a in ast.args)
+    def attach_ast_(ast: AstP, egraph: EGraph) -> int:
+        # dispatch on the type tag, see mini_lisp.core_types.is_parent.
+        # iterative post order, children left to right, so deep terms do not hit the recursion limit
+        attached: List[int] = []
+        stack: List[Tuple[AstP, bool]] = [(ast, False)]
+        while len(stack) > 0:
+            current, leaving = stack.pop()
+            if leaving:
+                start = len(attached) - (len(current.args) - 1)
+                args = tuple(attached[start:])
+                del attached[start:]
+                attached.append(egraph.attach_ast_node_(ENode(current.args[0], args)))
+            elif current.type == "class_ref":
+                attached.append(egraph.find(current.id))
+            elif current.type == "number" or current.type == "variable":
+                attached.append(egraph.attach_ast_node_(ENode(current)))
+            elif current.type == "ast_parent":
+                op = current.args[0]
+                if not (op.type == "number" or op.type == "variable"):
+                    raise Exception(f"Ast {current} has unexpected operator: {op}")
+                stack.append((current, True))
+                stack.extend((arg, False) for arg in reversed(current.args[1:]))
+            else:
+                raise Exception(f"Ast {current} has unexpected type: {type(current)}")
+        return attached[-1]
+
+    @classmethod
+    def empty(cls) -> EGraph:
+        return cls(classes={}, registry={})
 
     @classmethod
     def from_ast(cls, ast: AstP) -> EGraph:
-        egraph = cls(classes={}, registry={})
-        EGraph.attach_ast_(ast, egraph)
-        egraph.root_class = len(egraph.classes)
+        egraph = cls.empty()
+        egraph.add_expr(ast)
         return egraph
 
-    def merge_class_(self, from_class_id: int, to_class_id: int) -> None:
-        to_class = self.classes.pop(to_class_id)
-        self.classes[from_class_id] |= to_class
-        if to_class == self.root_class:
-            self.root_class = from_class_id
-        for n in to_class:
-            self.registry[n] = from_class_id
+    def add_expr(self, expr: Union[AstP, str]) -> int:
+        # shared subterms end up in the classes already holding them
+        class_id = EGraph.attach_ast_(parse(expr) if isinstance(expr, str) else expr, self)
+        self.roots.append(class_id)
+        if self.root_class is None:
+            self.root_class = class_id
+        return class_id
+
+    def add_exprs(self, source: Union[str, Iterable[str]]) -> List[int]:
+        # source: text, or its lines read lazily (e.g. an open file), holding any number of expressions
+        lines = [source] if isinstance(source, str) else source
+        return [self.add_expr(expr) for expr in read_exprs(scan_lines(lines))]
+
+    def save(self, path: str) -> None:
+        # flat binary snapshot, see snapshot.py
+        from snapshot import save_egraph
+        save_egraph(self, path)
+
+    @classmethod
+    def load(cls, path: str) -> EGraph:
+        # builds the whole graph, O(n). EGraphSnapshot.open maps the file without building anything
+        # and SnapshotGraph matches on it
+        from snapshot import load_egraph
+        return load_egraph(path, cls)
+
+    def merge_class_(self, from_class_id: int, to_class_id: int) -> int:
+        # registry is left untouched, congruence is restored by rebuild
+        from_class_id, to_class_id = self.find(from_class_id), self.find(to_class_id)
+        if from_class_id == to_class_id:
+            return from_class_id
+        new_root = self.uf.union_(from_class_id, to_class_id)
+        merged_id = to_class_id if new_root == from_class_id else from_class_id
+        merged = self.classes.pop(merged_id)
+        # always move the smaller member set into the larger one
+        if len(merged) > len(self.classes[new_root]):
+            merged, self.classes[new_root] = self.classes[new_root], merged
+        self.classes[new_root] |= merged
+        self.parents[new_root].extend(self.parents.pop(merged_id))
+        self.pending.append(new_root)
+        self.dirty.add(new_root)
+        self.touch_((from_class_id, to_class_id))
+        return new_root
 
     def apply_(self, rule_match_result: RuleMatchResult) -> None:
-        from_ast, to = rule_match_result
-        from_class_id = self.registry[from_ast]
+        # call rebuild after a batch of apply_ to restore congruence
+        index, to = rule_match_result
+        assert isinstance(index, ClassRef)
+        from_class_id = self.find(index.id)
         assert from_class_id in self.classes
-        if to not in self.registry:
-            self.registry[to] = from_class_id
-            self.classes[from_class_id].add(to)
-            EGraph.attach_ast_(to, self)
-        else:
-            to_class_id = self.registry[to]
-            if from_class_id != to_class_id:
-                self.merge_class_(from_class_id, to_class_id)
+        to_class_id = EGraph.attach_ast_(to, self)
+        if from_class_id != to_class_id:
+            self.merge_class_(from_class_id, to_class_id)
+
+    def instantiate_(self, template: RhsTemplate, symbols: Symbols) -> int:
+        # adds the template's nodes bottom up from the bound classes, returns the class of its root
+        from_symbol = symbols.from_symbol
+        stack: List[int] = []
+        for ins in template.instructions:
+            if ins.type == "push_class":
+                bound = from_symbol[ins.symbol]
+                # a symbol bound as an operator on the LHS stands for that leaf on the RHS
+                if bound.type == "class_ref":
+                    stack.append(self.find(bound.id))
+                else:
+                    stack.append(self.attach_ast_node_(ENode(bound)))
+            elif ins.type == "push_leaf":
+                stack.append(self.attach_ast_node_(ENode(ins.leaf)))
+            elif ins.type == "make_node":
+                op = from_symbol[ins.op] if isinstance(ins.op, Symbol) else ins.op
+                args = tuple(stack[len(stack) - ins.arity:])
+                del stack[len(stack) - ins.arity:]
+                stack.append(self.attach_ast_node_(ENode(op, args)))
+            else:
+                raise ValueError(f"Unknown instruction: {ins}")
+        return stack[-1]
+
+    def apply_match_(self, rule_match: RuleMatch) -> None:
+        # same as apply_ on the rule's RuleMatchResult, without building the RHS Ast
+        from_class_id = self.find(rule_match.class_id)
+        to_class_id = self.instantiate_(rule_match.rule.template, rule_match.symbols)
+        if from_class_id != to_class_id:
+            self.merge_class_(from_class_id, to_class_id)
+
+    def repair_(self, class_id: int) -> Set[int]:
+        # re-canonicalize the parents of a merged class, merging the ones that became equal
+        # a parent is kept once per canonical node, ids of congruent duplicates are dropped
+        parents, self.parents[class_id] = self.parents[class_id], array("i")
+        new_parents: Dict[ENode, int] = {}
+        for node_id in parents:
+            self.registry.pop(self.nodes[node_id], None)
+            p_node = self.canonicalize(self.nodes[node_id])
+            self.nodes[node_id] = p_node
+            if p_node in new_parents:
+                self.merge_class_(self.node_classes[new_parents[p_node]], self.node_classes[node_id])
+            else:
+                new_parents[p_node] = node_id
+            p_class_id = self.find(self.node_classes[node_id])
+            self.node_classes[node_id] = p_class_id
+            self.registry[p_node] = p_class_id
+        self.parents[self.find(class_id)].extend(new_parents.values())
+        return {self.find(self.node_classes[n]) for n in new_parents.values()}
+
+    def rebuild(self) -> None:
+        touched: Set[int] = set()
+        while len(self.pending) > 0:
+            todo = {self.find(c) for c in self.pending}
+            self.pending = []
+            for class_id in todo:
+                touched |= self.repair_(self.find(class_id))
+        for class_id in {self.find(c) for c in touched}:
+            self.classes[class_id] = {self.canonicalize(n) for n in self.classes[class_id]}
 
     def to_mermaid(self) -> MermaidGraph:
         ## assume the dict is in order (python >= 3.6)
-        node_ids: Dict[AstP, int] = {n: i for i, n in enumerate(self.registry.keys()) if n not in OPs}
+        nodes = [(class_id, node) for class_id, class_nodes in self.classes.items() for node in class_nodes]
 
         style_gen = NodeStyle.get_style_gen()
 
-        def style_format(node: AstNode[RawLeaves]) -> NodeStyle:
-            if isinstance(node, AstParent):
+        def style_format(node: ENode) -> NodeStyle:
+            if len(node.args) > 0:
                 return style_gen(1)
-            elif isinstance(node, Number):
+            elif node.op.type == "number":
                 return style_gen(2)
-            elif isinstance(node, Variable):
-                if node in OPs:
-                    raise RuntimeError("No OPs allowed here")
             return style_gen(4)
 
-        subgraph_eclass_id, subgraph_content = list(zip(*filter(lambda x: len(x[-1]) > 0,
-                                                                ((i, frozenset(node_ids[n] for n in v if n not in OPs))
-                                                                 for i, v in self.classes.items()))))
+        subgraph_eclass_id = list(self.classes.keys())
         subgraph_eclass_id_to_idx = {v: i for i, v in enumerate(subgraph_eclass_id)}
+        subgraph_content: List[Set[int]] = [set() for _ in subgraph_eclass_id]
+        for node_id, (class_id, _) in enumerate(nodes):
+            subgraph_content[subgraph_eclass_id_to_idx[class_id]].add(node_id)
 
         def make_link(i: int, j: int, arg_n: int) -> Link:
             return Link(Linkable(i, LinkableType.Node), Linkable(j, LinkableType.Subgraph), content=f"{arg_n}")
 
-        links = list(make_link(node_from_id, subgraph_eclass_id_to_idx[self.registry[node_to]], arg_n)
-                     for node_from, node_from_id in node_ids.items()
-                     if isinstance(node_from, AstParent)
-                     for arg_n, node_to in enumerate(node_from.args[1:]))
+        # links follow the parent lists of every class instead of the children of every node
+        node_ids = {node: node_id for node_id, (_, node) in enumerate(nodes)}
+        links = []
+        for class_to, parents in self.parents.items():
+            for parent_id in dict.fromkeys(parents):
+                node_from = self.nodes[parent_id]
+                if node_from not in node_ids:
+                    continue
+                links.extend(make_link(node_ids[node_from], subgraph_eclass_id_to_idx[class_to], arg_n)
+                             for arg_n, arg in enumerate(node_from.args) if self.find(arg) == class_to)
 
         return MermaidGraph(
-            sub_graphs=subgraph_content,
+            sub_graphs=[frozenset(c) for c in subgraph_content],
             links=links,
             subgraph_names=[f"\"{get_rounded_num(i)}\"" for i in subgraph_eclass_id],
-            node_names={node_ids[k]: f"{k.display}"
-            if not isinstance(k, AstParent)
-            else f"{k.args[0].display}"
-                        for k in self.registry.keys()
-                        if k not in OPs},
-            node_styles={node_ids[k]: style_format(k) for k in self.registry.keys() if k not in OPs},
+            node_names={node_id: f"{node.op.display}" for node_id, (_, node) in enumerate(nodes)},
+            node_styles={node_id: style_format(node) for node_id, (_, node) in enumerate(nodes)},
         )
@@ -1,52 +1,150 @@
 from __future__ import annotations
 
-from egraph import EGraph, AstP
-from mini_lisp.core_types import AstParent
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Tuple, Optional, NamedTuple, Iterable, Union, List, Sequence
+
+from egraph import EGraph, AstP, ENode
+from mini_lisp.core import parse
+from mini_lisp.core_types import is_parent
+
+DEBUG = False
+
+# (canonical class id, subterm) -> whether the class holds the subterm
+EqualMemo = Dict[Tuple[int, AstP], bool]
+# subterm -> class holding it, None when no class does
+LookupMemo = Dict[AstP, Optional[int]]
+
+
+class HashconsSnapshot(NamedTuple):
+    # read only copy of a rebuilt graph's hashcons with canonical ids, cheap to send to worker processes
+    hashcons: Dict[ENode, int]
+    root_class: int
+
+    @staticmethod
+    def from_egraph(graph: EGraph) -> HashconsSnapshot:
+        if len(graph.pending) > 0:
+            raise RuntimeError("Graph has merges pending, rebuild it before taking a snapshot")
+        return HashconsSnapshot({graph.canonicalize(node): graph.find(class_id)
+                                 for node, class_id in graph.registry.items()},
+                                graph.find(graph.root_class))
+
+    def lookup(self, node: ENode) -> Optional[int]:
+        return self.hashcons.get(node)
+
+
+class EqualityResult(NamedTuple):
+    query: AstP
+    equal: bool
+    # class holding the query, None when the graph does not hold it
+    class_id: Optional[int]
 
 
 def print_result(fn):
     def wrapper(*args, **kwargs):
         result = fn(*args, **kwargs)
-        print(f"result: {result}")
+        if DEBUG:
+            print(f"result: {result}")
         return result
 
     return wrapper
 
 
+def lookup_ast(graph: Union[EGraph, HashconsSnapshot], to_test: AstP,
+               memo: Optional[LookupMemo] = None) -> Optional[int]:
+    # bottom up through the hashcons in O(term size), a term is held by at most one class
+    if memo is not None and to_test in memo:
+        return memo[to_test]
+    if is_parent(to_test):
+        args = []
+        for arg in to_test.args[1:]:
+            class_id = lookup_ast(graph, arg, memo)
+            if class_id is None:
+                break
+            args.append(class_id)
+        else:
+            class_id = graph.lookup(ENode(to_test.args[0], tuple(args)))
+    else:
+        class_id = graph.lookup(ENode(to_test))
+    if memo is not None:
+        memo[to_test] = class_id
+    return class_id
+
+
 @print_result
-def equal_ast_class_node(graph: EGraph, class_node: AstP, to_test: AstP) -> bool:
-    print(f"checking \n {class_node.display}\n == \n {to_test.display}")
-    if isinstance(to_test, AstParent):
-        if not isinstance(class_node, AstParent):
+def equal_ast_class_node(graph: EGraph, class_node: ENode, to_test: AstP, memo: EqualMemo) -> bool:
+    if DEBUG:
+        print(f"checking \n {class_node.display}\n == \n {to_test.display}")
+    if is_parent(to_test):
+        if class_node.op != to_test.args[0] or len(class_node.args) != len(to_test.args) - 1:
             return False
         else:
-            for arg1, arg2 in zip(class_node.args[1:], to_test.args[1:]):
-                assert arg1 in graph.registry
-                if not equal_ast_node(graph, arg1, arg2):
+            for arg1, arg2 in zip(class_node.args, to_test.args[1:]):
+                if not equal_ast_node(graph, arg1, arg2, memo):
                     return False
             else:
                 return True
     else:
-        if isinstance(class_node, AstParent):
-            return False
-        elif to_test == class_node:
-            return True
-        else:
-            if to_test in graph.registry:
-                assert class_node in graph.registry
-                return graph.registry[to_test] == graph.registry[class_node]
-            else:
-                return False
+        return class_node == ENode(to_test)
 
 
-def equal_ast_node(graph: EGraph, node: AstP, to_test: AstP) -> bool:
-    class_id = graph.registry[node]
-    for class_node in graph.classes[class_id]:
-        if equal_ast_class_node(graph, class_node, to_test):
-            return True
-    else:
-        return False
+def equal_ast_node(graph: EGraph, class_id: int, to_test: AstP, memo: Optional[EqualMemo] = None) -> bool:
+    # every (class, subterm) pair is explored once, subterms are interned so keys hash by identity
+    class_id = graph.find(class_id)
+    if memo is None:
+        memo = {}
+    key = (class_id, to_test)
+    if key not in memo:
+        memo[key] = any(equal_ast_class_node(graph, class_node, to_test, memo)
+                        for class_node in graph.classes[class_id])
+    return memo[key]
 
 
 def equal_ast(graph: EGraph, to_test: AstP) -> bool:
-    return equal_ast_node(graph, next(iter(graph.classes[graph.root_class])), to_test)
+    if len(graph.pending) > 0:
+        # until rebuild a hit can be a class congruent to the root but not merged with it yet
+        return equal_ast_node(graph, graph.root_class, to_test)
+    # congruence is up to date, so a term is in exactly the class the hashcons finds, if any
+    class_id = lookup_ast(graph, to_test)
+    return class_id is not None and class_id == graph.find(graph.root_class)
+
+
+_worker_snapshot: Optional[HashconsSnapshot] = None
+
+
+def _init_worker(snapshot: HashconsSnapshot) -> None:
+    global _worker_snapshot
+    _worker_snapshot = snapshot
+
+
+def _lookup_chunk(queries: Sequence[AstP]) -> List[Optional[int]]:
+    memo: LookupMemo = {}
+    return [lookup_ast(_worker_snapshot, query, memo) for query in queries]
+
+
+def check_equalities(graph: EGraph, queries: Iterable[Union[AstP, str]], processes: Optional[int] = None,
+                     chunk_size: int = 256) -> List[EqualityResult]:
+    # Checks every query against the root class. Subterms shared between queries are looked up once.
+    # With processes set, chunks of queries are looked up in a process pool against a
+    # snapshot of the hashcons, which needs a rebuilt graph
+    queries = [parse(q) if isinstance(q, str) else q for q in queries]
+    if processes is None:
+        memo: LookupMemo = {}
+        equal_memo: EqualMemo = {}
+        root = graph.find(graph.root_class)
+        results = []
+        for query in queries:
+            class_id = lookup_ast(graph, query, memo)
+            if len(graph.pending) > 0:
+                # see equal_ast, a hit is a class holding the query but maybe not the only one
+                equal = equal_ast_node(graph, root, query, equal_memo)
+            else:
+                equal = class_id == root
+            results.append(EqualityResult(query, equal, class_id))
+        return results
+    else:
+        snapshot = HashconsSnapshot.from_egraph(graph)
+        chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(snapshot,)) as pool:
+            class_ids = [class_id for chunk in pool.map(_lookup_chunk, chunks) for class_id in chunk]
+        return [EqualityResult(query, class_id == snapshot.root_class, class_id)
+                for query, class_id in zip(queries, class_ids)]
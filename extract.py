@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Sequence, Dict, Tuple, Mapping, Set, List, Optional
+
+from egraph import EGraph, ENode, AstP
+from mini_lisp.core import Ast
+
+# cost of a node given the best costs of its children
+CostFunction = Callable[[ENode, Sequence[float]], float]
+
+
+def ast_size(node: ENode, child_costs: Sequence[float]) -> float:
+    return 1 + sum(child_costs)
+
+
+def ast_depth(node: ENode, child_costs: Sequence[float]) -> float:
+    return 1 + max(child_costs, default=0)
+
+
+def op_weights(weights: Mapping[str, float], default: float = 1) -> CostFunction:
+    # tree cost with a weight per operator, e.g. {'<<': 1, '*': 4}
+    def cost(node: ENode, child_costs: Sequence[float]) -> float:
+        return weights.get(node.op.display, default) + sum(child_costs)
+
+    return cost
+
+
+@dataclass
+class Extractor:
+    # best: canonical class id -> (cost, cheapest node), computed bottom up on construction
+    egraph: EGraph
+    cost_fn: CostFunction = ast_size
+    best: Dict[int, Tuple[float, ENode]] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.find_costs_()
+
+    def node_cost(self, node: ENode) -> Optional[float]:
+        # None until every child has a cost, which is how cycles are kept out
+        child_costs = []
+        for arg in node.args:
+            child_best = self.best.get(self.egraph.find(arg))
+            if child_best is None:
+                return None
+            child_costs.append(child_best[0])
+        return self.cost_fn(node, child_costs)
+
+    def find_costs_(self) -> None:
+        # worklist fixpoint: a class is only revisited when one of its children got cheaper
+        graph = self.egraph
+        todo = deque(c for c, nodes in graph.classes.items() if any(len(n.args) == 0 for n in nodes))
+        queued: Set[int] = set(todo)
+        while len(todo) > 0:
+            class_id = todo.popleft()
+            queued.discard(class_id)
+            improved = False
+            for node in graph.classes[class_id]:
+                cost = self.node_cost(node)
+                if cost is not None and (class_id not in self.best or cost < self.best[class_id][0]):
+                    self.best[class_id] = (cost, node)
+                    improved = True
+            if improved:
+                for _, parent_class_id in graph.parent_nodes(class_id):
+                    if parent_class_id not in queued:
+                        queued.add(parent_class_id)
+                        todo.append(parent_class_id)
+
+    def find_best_cost(self, class_id: int) -> float:
+        return self.best[self.egraph.find(class_id)][0]
+
+    def find_best(self, class_id: int) -> Tuple[float, AstP]:
+        class_id = self.egraph.find(class_id)
+        if class_id not in self.best:
+            raise RuntimeError(f"Class {class_id} has no finite cost, every node in it is part of a cycle")
+        return self.best[class_id][0], build_term(self.egraph, {c: n for c, (_, n) in self.best.items()}, class_id)
+
+
+def build_term(egraph: EGraph, choice: Mapping[int, ENode], class_id: int) -> AstP:
+    # rebuild the term picked by choice (canonical class id -> node) as an Ast,
+    # iterative post order so deep terms do not hit the recursion limit
+    class_id = egraph.find(class_id)
+    built: Dict[int, AstP] = {}
+    visiting: Set[int] = set()
+    stack: List[int] = [class_id]
+    while len(stack) > 0:
+        current = stack[-1]
+        if current in built:
+            stack.pop()
+            continue
+        node = choice[current]
+        children = [egraph.find(a) for a in node.args]
+        missing = [c for c in children if c not in built]
+        if len(missing) == 0:
+            stack.pop()
+            visiting.discard(current)
+            built[current] = Ast((node.op, *(built[c] for c in children))) if len(children) > 0 else node.op
+        else:
+            if current in visiting:
+                raise RuntimeError(f"Choice has a cycle through class {current}")
+            visiting.add(current)
+            stack.extend(missing)
+    return built[class_id]
+
+
+def extract(egraph: EGraph, cost_fn: CostFunction = ast_size) -> Tuple[float, AstP]:
+    return Extractor(egraph, cost_fn).find_best(egraph.root_class)
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Set, List, NamedTuple, Mapping
+
+from egraph import EGraph, ENode, AstP
+from extract import Extractor, build_term
+
+# cost of a node on its own, every class used by the term is paid for once
+NodeCost = Callable[[ENode], float]
+
+
+def unit_cost(node: ENode) -> float:
+    return 1
+
+
+def op_node_weights(weights: Mapping[str, float], default: float = 1) -> NodeCost:
+    def cost(node: ENode) -> float:
+        return weights.get(node.op.display, default)
+
+    return cost
+
+
+class DagExtraction(NamedTuple):
+    cost: float
+    term: AstP
+    # DAG cost of the tree-cost extraction the search started from
+    greedy_cost: float
+    # True when branch and bound finished, so cost is optimal
+    exact: bool
+
+    @property
+    def gap(self) -> float:
+        return self.greedy_cost - self.cost
+
+
+@dataclass
+class DagExtractor:
+    # Minimizes the DAG cost: shared subterms are counted once.
+    # Starts from the tree-cost extraction, then runs branch and bound when the root reaches at
+    # most exact_limit classes, otherwise local search, both within time_limit seconds.
+    # Branch and bound may use exact_share of the time, when it runs out local search improves
+    # its best selection in the rest
+    egraph: EGraph
+    node_cost: NodeCost = unit_cost
+    time_limit: float = 1.0
+    exact_limit: int = 64
+    exact_share: float = 0.5
+    deadline: float = 0.0
+    min_costs: Dict[int, float] = field(default_factory=dict)
+
+    def dag_cost(self, choice: Mapping[int, ENode], root: int) -> float:
+        # sum over every class reachable through choice, inf when choice has a cycle
+        total = 0.0
+        done: Set[int] = set()
+        on_path: Set[int] = set()
+        stack = [(root, False)]
+        while len(stack) > 0:
+            class_id, leaving = stack.pop()
+            if leaving:
+                on_path.discard(class_id)
+                done.add(class_id)
+                continue
+            if class_id in on_path:
+                return float("inf")
+            if class_id in done:
+                continue
+            node = choice[class_id]
+            total += self.node_cost(node)
+            on_path.add(class_id)
+            stack.append((class_id, True))
+            stack.extend((self.egraph.find(a), False) for a in node.args)
+        return total
+
+    def reachable(self, choice: Mapping[int, ENode], root: int) -> List[int]:
+        seen = {root}
+        stack = [root]
+        while len(stack) > 0:
+            for a in choice[stack.pop()].args:
+                a = self.egraph.find(a)
+                if a not in seen:
+                    seen.add(a)
+                    stack.append(a)
+        return list(seen)
+
+    def reachable_classes(self, root: int) -> Set[int]:
+        # every class some choice could reach from root, through any node of each class
+        seen = {root}
+        stack = [root]
+        while len(stack) > 0:
+            for node in self.egraph.classes[stack.pop()]:
+                for a in node.args:
+                    a = self.egraph.find(a)
+                    if a not in seen:
+                        seen.add(a)
+                        stack.append(a)
+        return seen
+
+    def greedy_choice(self) -> Dict[int, ENode]:
+        node_cost = self.node_cost
+        extractor = Extractor(self.egraph, lambda node, child_costs: node_cost(node) + sum(child_costs))
+        return {c: n for c, (_, n) in extractor.best.items()}
+
+    def local_search(self, choice: Dict[int, ENode], root: int) -> float:
+        # switch one class at a time to a cheaper node until nothing improves or time is up
+        best_cost = self.dag_cost(choice, root)
+        improved = True
+        while improved and time.perf_counter() < self.deadline:
+            improved = False
+            for class_id in self.reachable(choice, root):
+                current = choice[class_id]
+                for node in self.egraph.classes[class_id]:
+                    if node == current or any(self.egraph.find(a) not in choice for a in node.args):
+                        continue
+                    choice[class_id] = node
+                    cost = self.dag_cost(choice, root)
+                    if cost < best_cost:
+                        best_cost, current, improved = cost, node, True
+                    else:
+                        choice[class_id] = current
+                if time.perf_counter() >= self.deadline:
+                    break
+        return best_cost
+
+    def branch_and_bound(self, choice: Dict[int, ENode], root: int, upper: float, classes: Set[int]) -> bool:
+        # returns True when the whole search space was covered, choice holds the best selection.
+        # classes holds every class reachable from root
+        graph = self.egraph
+        self.min_costs = {c: min(self.node_cost(n) for n in graph.classes[c]) for c in classes}
+        best: List = [upper, dict(choice)]
+        partial: Dict[int, ENode] = {}
+
+        def search(todo: List[int], cost: float) -> bool:
+            if time.perf_counter() >= self.deadline:
+                return False
+            todo = [c for c in todo if c not in partial]
+            if len(todo) == 0:
+                total = self.dag_cost(partial, root)
+                if total < best[0]:
+                    best[0], best[1] = total, dict(partial)
+                return True
+            # every class still to be picked costs at least its cheapest node
+            if cost + sum(self.min_costs[c] for c in set(todo)) >= best[0]:
+                return True
+            class_id = todo[-1]
+            for node in sorted(graph.classes[class_id], key=self.node_cost):
+                children = [graph.find(a) for a in node.args]
+                if class_id in children:
+                    continue
+                partial[class_id] = node
+                finished = search(todo[:-1] + children, cost + self.node_cost(node))
+                del partial[class_id]
+                if not finished:
+                    return False
+            return True
+
+        exhausted = search([root], 0.0)
+        choice.clear()
+        choice.update(best[1])
+        return exhausted
+
+    def find_best(self, class_id: int) -> DagExtraction:
+        start = time.perf_counter()
+        self.deadline = start + self.time_limit
+        root = self.egraph.find(class_id)
+        choice = self.greedy_choice()
+        if root not in choice:
+            raise RuntimeError(f"Class {root} has no finite cost, every node in it is part of a cycle")
+        greedy_cost = self.dag_cost(choice, root)
+        exact = False
+        classes = self.reachable_classes(root)
+        if len(classes) <= self.exact_limit:
+            self.deadline = start + self.exact_share * self.time_limit
+            exact = self.branch_and_bound(choice, root, greedy_cost + 1e-9, classes)
+            self.deadline = start + self.time_limit
+        if not exact:
+            self.local_search(choice, root)
+        return DagExtraction(
+            cost=self.dag_cost(choice, root),
+            term=build_term(self.egraph, choice, root),
+            greedy_cost=greedy_cost,
+            exact=exact,
+        )
+
+
+def extract_dag(egraph: EGraph, node_cost: NodeCost = unit_cost, time_limit: float = 1.0,
+                exact_limit: int = 64) -> DagExtraction:
+    return DagExtractor(egraph, node_cost, time_limit, exact_limit).find_best(egraph.root_class)
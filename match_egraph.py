@@ -1,71 +1,197 @@
 from __future__ import annotations
 
-from typing import Optional, FrozenSet
+import time
+from typing import FrozenSet, Iterator, Tuple, Literal, List, Dict, Optional, Callable, AbstractSet
 
-from egraph import EGraph, AstP
+from egraph import EGraph, ENode, ClassRef
 from mini_lisp.core import Symbols
-from mini_lisp.core_types import Number, AstParent, Symbol
+from mini_lisp.core_types import AstParent, Symbol, AstNode, AstLeaf, is_parent
+from mini_lisp.pattern_program import PatternProgram
 from mini_lisp.patterns import MatchResult
-from mini_lisp.rules import Rule, RuleMatchResult
+from mini_lisp.rules import Rule, RuleMatchResult, RuleMatch
+from relational_match import match_relational
 
 
-def match_rule(egraph: EGraph, rule: Rule) -> FrozenSet[RuleMatchResult]:
-    return frozenset(filter(None, (match_node(egraph, node, rule) for node in egraph.registry)))
+# recursive: walks the PartialAst pattern, compiled: runs the rule's PatternProgram,
+# relational: generic join over per operator tables, see relational_match.py
+MatchBackend = Literal["recursive", "compiled", "relational"]
 
 
-def match_node(graph: EGraph, node: AstP, rule: Rule) -> Optional[RuleMatchResult]:
-    result = match_node_helper(graph, node, rule.lhs, Symbols.empty())
-    return rule.apply(MatchResult(node, result)) if result is not None else None
+def get_matcher(backend: MatchBackend) -> Callable[[EGraph, int, ENode, Rule], Iterator[Symbols]]:
+    if backend == "recursive":
+        return match_node
+    elif backend == "compiled":
+        return match_node_compiled
+    else:
+        raise ValueError(f"Unknown match backend: {backend}")
 
 
-def match_class_helper(graph: EGraph, class_id: int, to_match: AstP, session_symbols: Symbols) -> Optional[MatchResult]:
-    # Only return the first one matched
-    for node in graph.classes[class_id]:
-        result = match_node_helper(graph, node, to_match, session_symbols)
-        if result is not None:
-            return MatchResult(node, result)
+def match_symbols(egraph: EGraph, rule: Rule, backend: MatchBackend = "compiled",
+                  shard: Optional[Tuple[int, int]] = None,
+                  roots: Optional[AbstractSet[int]] = None) -> Iterator[Tuple[int, Symbols]]:
+    # shard=(k, n) keeps matches rooted at classes with id % n == k, roots keeps the ones rooted in roots
+    if shard is None and roots is None:
+        keep = None
     else:
-        return None
+        def keep(class_id: int) -> bool:
+            return (shard is None or class_id % shard[1] == shard[0]) and (roots is None or class_id in roots)
+    if backend == "relational" and is_parent(rule.lhs):
+        return match_relational(egraph, rule, keep)
+    # a leaf pattern is no join, it goes through the compiled matcher
+    matcher = get_matcher("compiled" if backend == "relational" else backend)
+    return ((class_id, symbols)
+            for class_id, node in match_candidates(egraph, rule.lhs, roots)
+            if keep is None or keep(class_id)
+            for symbols in matcher(egraph, class_id, node, rule))
+
+
+def match_rule(egraph: EGraph, rule: Rule, backend: MatchBackend = "compiled") -> FrozenSet[RuleMatchResult]:
+    # every match with its RHS built as an Ast
+    return frozenset(rule.apply(MatchResult(ClassRef(class_id), symbols))
+                     for class_id, symbols in match_symbols(egraph, rule, backend))
+
 
+def search_matches(egraph: EGraph, rule: Rule, backend: MatchBackend = "compiled",
+                   roots: Optional[AbstractSet[int]] = None, deadline: Optional[float] = None) -> FrozenSet[RuleMatch]:
+    # every match as bindings only, EGraph.apply_match_ adds the RHS from the rule's template
+    # with a deadline (a time.perf_counter() value), the matches found by then once it has passed
+    found = (RuleMatch(rule, class_id, symbols)
+             for class_id, symbols in match_symbols(egraph, rule, backend, roots=roots))
+    if deadline is None:
+        return frozenset(found)
+    matches = set()
+    for i, match in enumerate(found):
+        matches.add(match)
+        if i % 1024 == 1023 and time.perf_counter() > deadline:
+            break
+    return frozenset(matches)
+
+
+def match_candidates(egraph: EGraph, to_match: AstNode[AstLeaf],
+                     roots: Optional[AbstractSet[int]] = None) -> Iterator[Tuple[int, ENode]]:
+    # only nodes whose head and arity agree with the pattern root can match, and only in roots when given
+    if is_parent(to_match) and not isinstance(to_match.args[0], Symbol):
+        op, arity = to_match.args[0], len(to_match.args) - 1
+        class_ids = egraph.classes_with_op(op, arity)
+        if roots is not None:
+            class_ids = roots & class_ids if len(roots) < len(class_ids) else class_ids & roots
+        return ((class_id, node)
+                for class_id in class_ids
+                for node in egraph.classes[class_id]
+                if node.op == op and len(node.args) == arity)
+    classes = egraph.classes.items() if roots is None else ((c, egraph.classes[c]) for c in roots)
+    if is_parent(to_match):
+        return ((class_id, node) for class_id, nodes in classes for node in nodes)
+    else:
+        # leaf patterns match whole classes, one node per class is enough
+        return ((class_id, next(iter(nodes))) for class_id, nodes in classes)
 
-# Symbols: contains symbol <-> Ast information
+
+def match_node(graph: EGraph, class_id: int, node: ENode, rule: Rule) -> Iterator[Symbols]:
+    if is_parent(rule.lhs):
+        return match_node_helper(graph, node, rule.lhs, Symbols.empty())
+    else:
+        return (result.symbols for result in match_class_helper(graph, class_id, rule.lhs, Symbols.empty()))
+
+
+# Every matcher below yields all consistent bindings
+# Symbols: contains symbol <-> class (or operator) information
 # session_symbols: symbols that are matched and confirmed in the current match session
-def match_node_helper(graph: EGraph, node: AstP, to_match: AstP, session_symbols: Symbols) -> Optional[Symbols]:
-    if isinstance(to_match, AstParent):
-        if not isinstance(node, AstParent):
-            return None
-        else:
-            if len(node.args) != len(to_match.args):
-                return None
-            for arg1, arg2 in zip(node.args, to_match.args):
-                assert arg1 in graph.registry
-                result = match_class_helper(graph, graph.registry[arg1], arg2, session_symbols)
-                if result is not None:
-                    session_symbols |= result.symbols
-                else:
-                    return None
-            else:
-                return session_symbols
+def match_class_helper(graph: EGraph, class_id: int, to_match: AstNode[AstLeaf],
+                       session_symbols: Symbols) -> Iterator[MatchResult]:
+    class_id = graph.find(class_id)
+    if isinstance(to_match, Symbol):
+        # symbols bind to whole classes
+        bound = session_symbols.from_symbol.get(to_match)
+        if bound is None:
+            yield MatchResult(ClassRef(class_id),
+                              session_symbols | Symbols.from_from_symbol({to_match: ClassRef(class_id)}))
+        elif bound == ClassRef(class_id):
+            yield MatchResult(ClassRef(class_id), session_symbols)
+    elif not is_parent(to_match):
+        if graph.lookup(ENode(to_match)) == class_id:
+            yield MatchResult(ClassRef(class_id), session_symbols)
     else:
-        if isinstance(to_match, Symbol):
-            # symbol is not there or has same value
-            if node == session_symbols.from_symbol.get(to_match, node):
-                return Symbols.from_from_symbol({to_match: node})
+        for node in graph.classes[class_id]:
+            for symbols in match_node_helper(graph, node, to_match, session_symbols):
+                yield MatchResult(ClassRef(class_id), symbols)
+
+
+def match_node_helper(graph: EGraph, node: ENode, to_match: AstParent[AstLeaf],
+                      session_symbols: Symbols) -> Iterator[Symbols]:
+    if len(node.args) != len(to_match.args) - 1:
+        return
+    op = to_match.args[0]
+    if isinstance(op, Symbol):
+        # a symbol in operator position binds to the operator itself
+        bound = session_symbols.from_symbol.get(op)
+        if bound is None:
+            session_symbols = session_symbols | Symbols.from_from_symbol({op: node.op})
+        elif bound != node.op:
+            return
+    elif op != node.op:
+        return
+    yield from match_args_helper(graph, node.args, to_match.args[1:], session_symbols)
+
+
+def match_args_helper(graph: EGraph, class_ids: Tuple[int, ...], to_match_args: Tuple[AstNode[AstLeaf], ...],
+                      session_symbols: Symbols) -> Iterator[Symbols]:
+    # backtracks over the members of each child class, pruning as soon as a binding conflicts
+    if len(class_ids) == 0:
+        yield session_symbols
+    else:
+        for result in match_class_helper(graph, class_ids[0], to_match_args[0], session_symbols):
+            yield from match_args_helper(graph, class_ids[1:], to_match_args[1:], result.symbols)
+
+
+def match_node_compiled(graph: EGraph, class_id: int, node: ENode, rule: Rule) -> Iterator[Symbols]:
+    return run_program(graph, rule.program, class_id, node)
+
+
+def run_program(graph: EGraph, program: PatternProgram, class_id: int,
+                root_node: Optional[ENode] = None) -> Iterator[Symbols]:
+    # the first bind only looks at root_node when given, so each match is rooted at one node
+    if not program.matchable:
+        return
+    instructions = program.instructions
+    regs: List[int] = [0] * program.n_regs
+    regs[0] = graph.find(class_id)
+    ops: Dict[Symbol, AstLeaf] = {}
+
+    def step(pc: int) -> Iterator[Symbols]:
+        if pc == len(instructions):
+            from_symbol = {s: ClassRef(graph.find(regs[r])) for s, r in program.symbol_regs}
+            from_symbol.update(ops)
+            yield Symbols.from_from_symbol(from_symbol)
+            return
+        ins = instructions[pc]
+        if ins.type == "bind":
+            if pc == 0 and root_node is not None:
+                nodes = (root_node,)
             else:
-                return None
-        elif isinstance(node, AstParent):
-            return None
-        elif isinstance(node, Number) and isinstance(to_match, Symbol):
-            return Symbols.from_from_symbol({to_match: node})
+                nodes = graph.classes[graph.find(regs[ins.reg])]
+            for node in nodes:
+                if len(node.args) != ins.arity:
+                    continue
+                if isinstance(ins.op, Symbol):
+                    bound = ops.get(ins.op)
+                    if bound is None:
+                        ops[ins.op] = node.op
+                    elif bound != node.op:
+                        continue
+                elif node.op != ins.op:
+                    continue
+                regs[ins.out:ins.out + ins.arity] = node.args
+                yield from step(pc + 1)
+                if isinstance(ins.op, Symbol) and bound is None:
+                    del ops[ins.op]
+        elif ins.type == "compare":
+            if graph.find(regs[ins.reg]) == graph.find(regs[ins.other]):
+                yield from step(pc + 1)
+        elif ins.type == "check_leaf":
+            if graph.lookup(ENode(ins.leaf)) == graph.find(regs[ins.reg]):
+                yield from step(pc + 1)
         else:
-            if to_match != node:
-                if to_match in graph.registry:
-                    assert node in graph.registry
-                    if graph.registry[to_match] != graph.registry[node]:
-                        return None
-                    else:
-                        return Symbols.empty()
-                else:
-                    return None
-            else:
-                return Symbols.empty()
+            raise ValueError(f"Unknown instruction: {ins}")
+
+    yield from step(0)
@@ -1,11 +1,12 @@
 from __future__ import annotations
 
+import re
 from abc import abstractmethod
 from dataclasses import dataclass
 from typing import TypeVar, Tuple, Union, NamedTuple, Optional, Type, List, Literal, Protocol, ItemsView, Generic, \
-    Callable
+    Callable, Iterator, Iterable
 
-from mini_lisp.core_types import Symbol, AstLeaf, Number, Variable, AstNode, AstParent
+from mini_lisp.core_types import Symbol, AstLeaf, Number, Variable, AstNode, AstParent, Interned
 from mini_lisp.tree_utils import tree_replace, tree_display, MyMapping, tree_parent_display
 
 T = TypeVar("T", bound=AstLeaf)
@@ -75,7 +76,8 @@ def get_symbols(node: AstNode[RawLeaves], hole_prefix: Optional[str] = None) ->
     return Symbols.from_to_symbol(to_symbol)
 
 
-class Ast(NamedTuple):
+class Ast(Interned):
+    __slots__ = ("args",)
     args: Tuple[AstNode[RawLeaves], ...]
     type: Literal["ast_parent"] = "ast_parent"
 
@@ -92,50 +94,114 @@ class Ast(NamedTuple):
         return tree_parent_display(self)
 
     def __repr__(self) -> str:
-        return f"{self.args[0].name}({','.join([a.name for a in self.args[1:]])})\ttype={self.type}"
+        return f"{self.args[0].display}({','.join([a.display for a in self.args[1:]])})\ttype={self.type}"
+
+
+# brackets, or runs of anything that is neither a bracket nor whitespace
+TOKEN_RE = re.compile(r"[()]|[^\s()]+")
+
+
+class Token(NamedTuple):
+    text: str
+    # 1 based
+    line: int
+    column: int
+
+
+class ParseError(ValueError):
+    pass
+
+
+def scan(s: str) -> Iterator[Token]:
+    # single pass, lines are counted between consecutive tokens only
+    line, line_start, last = 1, 0, 0
+    for m in TOKEN_RE.finditer(s):
+        start = m.start()
+        newlines = s.count("\n", last, start)
+        if newlines > 0:
+            line += newlines
+            line_start = s.rindex("\n", last, start) + 1
+        last = start
+        yield Token(m.group(), line, start - line_start + 1)
+
+
+def scan_lines(lines: Iterable[str]) -> Iterator[Token]:
+    # lazy over e.g. an open file, chunks must not split a token
+    line = 1
+    for chunk in lines:
+        for token in scan(chunk):
+            yield Token(token.text, line + token.line - 1, token.column)
+        line += chunk.count("\n")
 
 
 def tokenize(s: str) -> List[str]:
-    return s.replace("(", " ( ").replace(")", " ) ").split()
-
-
-def parse_tokens(tokens: List[str]) -> AstNode[RawLeaves]:
-    if len(tokens) == 0:
-        raise Exception("There must be something inside the parentheses")
-    elif len(tokens) == 1:
-        token = tokens[0]
-        try:
-            return Number.from_str(token)
-        except ValueError:
-            return Variable(token)
+    return TOKEN_RE.findall(s)
+
+
+def parse_leaf(token: str) -> AstNode[RawLeaves]:
+    try:
+        return Number.from_str(token)
+    except ValueError:
+        return Variable(token)
+
+
+def token_position(token: Union[str, Token], i: int) -> str:
+    # plain string tokens only know their index
+    if isinstance(token, Token):
+        return f"line {token.line}, column {token.column}"
     else:
-        assert len(tokens) >= 4
-        assert tokens[0] == "("
-        assert tokens[-1] == ")"
-        op = tokens[1]
-        assert isinstance(op, str)
-        args = []
-        i = 1
-        while i < len(tokens) - 1:
-            token = tokens[i]
-            if token == "(":
-                bracket_stack = 1
-                j = i
-                while True:
-                    if tokens[j] == ")":
-                        bracket_stack -= 1
-                        if bracket_stack == 1:
-                            break
-                    elif tokens[j] == "(":
-                        bracket_stack += 1
-                    j += 1
-                args.append(parse_tokens(tokens[i:j + 1]))
-                i = j + 1
+        return f"token {i}"
+
+
+def read_tokens(tokens: Iterable[Union[str, Token]]) -> Iterator[Tuple[AstNode[RawLeaves], Union[str, Token], int]]:
+    # iterative: one list of finished args per open bracket, so nesting depth is only bounded by memory
+    # yields every top level expression with its first token and that token's index as soon as it is closed
+    stack: List[List[AstNode[RawLeaves]]] = []
+    opened: List[Tuple[Union[str, Token], int]] = []
+    for i, token in enumerate(tokens):
+        text = token.text if isinstance(token, Token) else token
+        if text == "(":
+            stack.append([])
+            opened.append((token, i))
+        elif text == ")":
+            if len(stack) == 0:
+                raise ParseError(f"Unmatched ')' at {token_position(token, i)}")
+            args = stack.pop()
+            open_token, open_i = opened.pop()
+            if len(args) == 0:
+                raise ParseError(f"There must be something inside the parentheses at {token_position(open_token, open_i)}")
+            elif len(args) == 1:
+                raise ParseError(f"An operator needs at least one argument at {token_position(open_token, open_i)}")
+            node = Ast(tuple(args))
+            if len(stack) > 0:
+                stack[-1].append(node)
+            else:
+                yield node, open_token, open_i
+        else:
+            leaf = parse_leaf(text)
+            if len(stack) > 0:
+                stack[-1].append(leaf)
             else:
-                args.append(parse_tokens([token]))
-                i += 1
-        return Ast(tuple(args))
+                yield leaf, token, i
+    if len(stack) > 0:
+        open_token, open_i = opened[-1]
+        raise ParseError(f"Unclosed '(' at {token_position(open_token, open_i)}")
+
+
+def read_exprs(tokens: Iterable[Union[str, Token]]) -> Iterator[AstNode[RawLeaves]]:
+    # lazy, only the expression being read is held in memory
+    return (expr for expr, _, _ in read_tokens(tokens))
+
+
+def parse_tokens(tokens: Iterable[Union[str, Token]]) -> AstNode[RawLeaves]:
+    exprs = read_tokens(tokens)
+    first = next(exprs, None)
+    if first is None:
+        raise ParseError("Empty expression")
+    for _, token, i in exprs:
+        raise ParseError(f"Unexpected expression after the end of the first one at {token_position(token, i)}")
+    return first[0]
 
 
 def parse(s: str) -> AstNode[RawLeaves]:
-    return parse_tokens(tokenize(s))
+    return parse_tokens(scan(s))
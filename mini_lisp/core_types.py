@@ -1,12 +1,75 @@
 from __future__ import annotations
 
+import weakref
 from abc import abstractmethod
-from typing import TypeVar, runtime_checkable, Protocol, Tuple, Union, NamedTuple, Literal
+from typing import TypeVar, runtime_checkable, Protocol, Tuple, Union, Literal, Any
 
 from utils.misc import get_rounded_num
 
+# intern key (see Interned.intern_key) -> the one node with these fields,
+# an entry goes away with its node, so the table never outlives the trees in use
+_interned: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+
+class Interned:
+    # Base of the AST nodes: structurally equal nodes are the same object,
+    # so hashing and equality are by identity and O(1) however deep the tree is.
+    # Children are interned before their parent, so the lookup key costs O(arity).
+    # A subclass lists its fields in __slots__, in constructor order, and its `type` tag as a class attribute.
+    # Nodes are not tuples, tuples can not be weakly referenced. They are immutable and pickle through
+    # the constructor, so an unpickled or copied node is the interned one
+    __slots__ = ("__weakref__",)
+    _fields: Tuple[str, ...] = ()
+    type: str
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = cls.__slots__
+
+    def __new__(cls, *values):
+        if len(values) != len(cls._fields):
+            raise TypeError(f"{cls.__name__} takes {len(cls._fields)} fields, got {len(values)}")
+        key = cls.intern_key(values)
+        node = _interned.get(key)
+        if node is None:
+            node = object.__new__(cls)
+            for name, value in zip(cls._fields, values):
+                object.__setattr__(node, name, value)
+            _interned[key] = node
+        return node
 
-class Symbol(NamedTuple):
+    @classmethod
+    def intern_key(cls, values: Tuple) -> Tuple:
+        return cls, values
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return type(self), tuple(getattr(self, name) for name in self._fields)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self._fields)
+        return f"{type(self).__name__}({fields}, type={self.type!r})"
+
+    __hash__ = object.__hash__
+
+    def __eq__(self, other) -> bool:
+        return self is other
+
+    def __ne__(self, other) -> bool:
+        return self is not other
+
+
+def interned_count() -> int:
+    return len(_interned)
+
+
+class Symbol(Interned):
+    __slots__ = ("i",)
     i: int
     type: Literal["symbol"] = "symbol"
 
@@ -28,10 +91,17 @@ class Symbol(NamedTuple):
 AstLeafType = Literal["number", "variable", "symbol"]
 
 
-class Number(NamedTuple):
+class Number(Interned):
+    __slots__ = ("value",)
     value: Union[float, int]
     type: Literal["number"] = "number"
 
+    @classmethod
+    def intern_key(cls, values: Tuple) -> Tuple:
+        # 1 and 1.0 are equal as dict keys, but an int and a float are different numbers:
+        # they display, save and compare differently, Number(1) is not Number(1.0)
+        return cls, type(values[0]), values
+
     @classmethod
     def from_str(cls, token: str) -> Number:
         try:
@@ -51,7 +121,8 @@ class Number(NamedTuple):
             return f"{self.value:.2f}"
 
 
-class Variable(NamedTuple):
+class Variable(Interned):
+    __slots__ = ("name",)
     name: str
     type: Literal["variable"] = "variable"
 
@@ -106,3 +177,10 @@ class AstParent(Protocol[T]):
 
 
 AstNode = Union[T, AstParent[T]]
+
+
+# Hot paths dispatch on the `type` tag every node carries, the runtime_checkable
+# protocols above are kept for static typing: isinstance against them inspects
+# attributes and evaluates `display` of the whole subtree
+def is_parent(node: AstNode) -> bool:
+    return node.type == "ast_parent"
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+from typing import NamedTuple, Tuple, Literal, Union, List, Dict
+
+from mini_lisp.core_types import Symbol, AstLeaf, AstNode, AstParent, is_parent
+
+
+# Instructions of the e-matching machine, registers hold class ids
+# bind: for every node of the class in `reg` with head `op` and `arity` children,
+#       write the children to registers out .. out + arity - 1 and continue (backtracking point)
+#       a Symbol op binds the operator itself
+class Bind(NamedTuple):
+    reg: int
+    op: AstLeaf
+    arity: int
+    out: int
+    type: Literal["bind"] = "bind"
+
+
+# compare: the classes in `reg` and `other` must be the same (a symbol seen twice)
+class Compare(NamedTuple):
+    reg: int
+    other: int
+    type: Literal["compare"] = "compare"
+
+
+# check_leaf: the class in `reg` must hold `leaf`
+class CheckLeaf(NamedTuple):
+    reg: int
+    leaf: AstLeaf
+    type: Literal["check_leaf"] = "check_leaf"
+
+
+Instruction = Union[Bind, Compare, CheckLeaf]
+
+
+class PatternProgram(NamedTuple):
+    instructions: Tuple[Instruction, ...]
+    n_regs: int
+    # symbols bound to a class: symbol -> register, symbols bound to an operator
+    symbol_regs: Tuple[Tuple[Symbol, int], ...]
+    op_symbols: Tuple[Symbol, ...]
+
+    @property
+    def matchable(self) -> bool:
+        # a symbol can not be an operator and a class at the same time
+        return len({s for s, _ in self.symbol_regs} & set(self.op_symbols)) == 0
+
+    @property
+    def display(self) -> str:
+        return "\n".join(f"{i}: {ins}" for i, ins in enumerate(self.instructions))
+
+
+def pattern_height(pattern: AstNode[AstLeaf]) -> int:
+    # parent links from the root to the deepest leaf
+    if is_parent(pattern):
+        return 1 + max(pattern_height(arg) for arg in pattern.args[1:])
+    return 0
+
+
+def compile_pattern(pattern: AstNode[AstLeaf]) -> PatternProgram:
+    # register 0 holds the class the match is rooted at
+    instructions: List[Instruction] = []
+    symbol_regs: Dict[Symbol, int] = {}
+    op_symbols: Dict[Symbol, None] = {}
+    n_regs = 1
+
+    def visit_leaf(leaf: AstLeaf, reg: int) -> None:
+        if isinstance(leaf, Symbol):
+            if leaf in symbol_regs:
+                instructions.append(Compare(reg, symbol_regs[leaf]))
+            else:
+                symbol_regs[leaf] = reg
+        else:
+            instructions.append(CheckLeaf(reg, leaf))
+
+    def visit_parent(node: AstParent[AstLeaf], reg: int) -> None:
+        nonlocal n_regs
+        op, args = node.args[0], node.args[1:]
+        out = n_regs
+        n_regs += len(args)
+        instructions.append(Bind(reg, op, len(args), out))
+        if isinstance(op, Symbol):
+            op_symbols[op] = None
+        # cheap leaf checks first, so a failing node is rejected before descending
+        for i, arg in enumerate(args):
+            if not is_parent(arg):
+                visit_leaf(arg, out + i)
+        for i, arg in enumerate(args):
+            if is_parent(arg):
+                visit_parent(arg, out + i)
+
+    if is_parent(pattern):
+        visit_parent(pattern, 0)
+    else:
+        visit_leaf(pattern, 0)
+    return PatternProgram(
+        instructions=tuple(instructions),
+        n_regs=n_regs,
+        symbol_regs=tuple(symbol_regs.items()),
+        op_symbols=tuple(op_symbols),
+    )
+
+
+# Instructions of the RHS template, a post order stack machine that adds e-nodes straight to the graph
+# push_class: push the class bound to `symbol`, or the class of its leaf when it is bound to an operator
+class PushClass(NamedTuple):
+    symbol: Symbol
+    type: Literal["push_class"] = "push_class"
+
+
+# push_leaf: push the class holding `leaf`, adding it when missing
+class PushLeaf(NamedTuple):
+    leaf: AstLeaf
+    type: Literal["push_leaf"] = "push_leaf"
+
+
+# make_node: pop `arity` classes and push the class of the node with head `op` over them
+#            a Symbol op is the operator bound by the match
+class MakeNode(NamedTuple):
+    op: AstLeaf
+    arity: int
+    type: Literal["make_node"] = "make_node"
+
+
+TemplateInstruction = Union[PushClass, PushLeaf, MakeNode]
+
+
+class RhsTemplate(NamedTuple):
+    instructions: Tuple[TemplateInstruction, ...]
+
+    @property
+    def display(self) -> str:
+        return "\n".join(f"{i}: {ins}" for i, ins in enumerate(self.instructions))
+
+
+def compile_template(rhs: AstNode[AstLeaf]) -> RhsTemplate:
+    instructions: List[TemplateInstruction] = []
+
+    def visit(node: AstNode[AstLeaf]) -> None:
+        if is_parent(node):
+            for arg in node.args[1:]:
+                visit(arg)
+            instructions.append(MakeNode(node.args[0], len(node.args) - 1))
+        elif isinstance(node, Symbol):
+            instructions.append(PushClass(node))
+        else:
+            instructions.append(PushLeaf(node))
+
+    visit(rhs)
+    return RhsTemplate(tuple(instructions))
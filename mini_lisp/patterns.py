@@ -3,12 +3,13 @@ from __future__ import annotations
 from typing import NamedTuple, Tuple, FrozenSet, List, Optional, Literal, Dict
 
 from mini_lisp.core import Symbols, Ast, parse, RawLeaves, get_symbols
-from mini_lisp.core_types import Symbol, Variable, AstLeaf, AstNode, Number, AstParent
+from mini_lisp.core_types import Symbol, Variable, AstLeaf, AstNode, Number, AstParent, is_parent, Interned
 from mini_lisp.program import FreeAst, Program, FreeAstLeaves
 from mini_lisp.tree_utils import tree_replace, tree_parent_display
 
 
-class PartialAst(NamedTuple):
+class PartialAst(Interned):
+    __slots__ = ("args",)
     args: Tuple[AstNode[AstLeaf], ...]
     type: Literal["ast_parent"] = "ast_parent"
 
@@ -82,8 +83,8 @@ class PartialProgram(NamedTuple):
 def match_tree(tree_node: AstParent[RawLeaves], to_match: AstParent[AstLeaf]) -> Optional[Symbols]:
     new_table: Dict[Symbol, AstNode[RawLeaves]] = {}
     for arg1, arg2 in zip(tree_node.args, to_match.args):
-        if isinstance(arg2, AstParent):
-            if isinstance(arg1, AstParent):
+        if is_parent(arg2):
+            if is_parent(arg1):
                 res = match_tree(arg1, arg2)
                 if res is not None:
                     new_table.update(res.from_symbol)
@@ -109,8 +110,8 @@ class MatchResult(NamedTuple):
 
 def match(ast: AstNode[RawLeaves], to_match: AstNode[AstLeaf]) -> List[MatchResult]:
     sym_list = []
-    if isinstance(ast, AstParent):
-        if isinstance(to_match, AstParent):
+    if is_parent(ast):
+        if is_parent(to_match):
             res = match_tree(ast, to_match)
             if res is not None:
                 sym_list.append(MatchResult(ast, res))
@@ -119,7 +120,7 @@ def match(ast: AstNode[RawLeaves], to_match: AstNode[AstLeaf]) -> List[MatchResu
         return sym_list
 
     else:
-        if isinstance(to_match, AstParent):
+        if is_parent(to_match):
             return []
         else:
             return [MatchResult(ast, Symbols.from_from_symbol({to_match: ast}))]
@@ -6,7 +6,7 @@ from math import inf
 from typing import NamedTuple, Type, Tuple, Literal, Protocol, Union, TypeVar, runtime_checkable, List
 
 from mini_lisp.core import Symbols, Ast, parse, RawLeaves
-from mini_lisp.core_types import Symbol, AstNode, Variable, Number, AstParent, AstLeaf
+from mini_lisp.core_types import Symbol, AstNode, Variable, Number, AstParent, AstLeaf, is_parent, Interned
 from mini_lisp.tree_utils import tree_display, tree_replace, tree_parent_display
 
 
@@ -24,7 +24,8 @@ class FreeAstLeaves(Protocol):
 T = TypeVar("T", bound=AstLeaf)
 
 
-class FreeAst(NamedTuple):
+class FreeAst(Interned):
+    __slots__ = ("args",)
     args: Tuple[AstNode[FreeAstLeaves], ...]
     type: Literal["ast_parent"] = "ast_parent"
 
@@ -45,12 +46,13 @@ class FreeAst(NamedTuple):
             if isinstance(curr_node, Symbol):
                 min_symbol_id = min(min_symbol_id, curr_node.i)
                 max_symbol_id = max(max_symbol_id, curr_node.i)
-            elif isinstance(curr_node, AstParent):
+            elif is_parent(curr_node):
                 bfs.extend(list(curr_node.args))
         return min_symbol_id, max_symbol_id
 
 
-class OrderedFreeAst(NamedTuple):
+class OrderedFreeAst(Interned):
+    __slots__ = ("args",)
     args: Tuple[AstNode[FreeAstLeaves], ...]
     type: Literal["ast_parent"] = "ast_parent"
 
@@ -1,14 +1,21 @@
-from typing import NamedTuple, Literal, List, FrozenSet, Iterable
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import NamedTuple, Literal, List, FrozenSet, Iterable, Optional
 
 from mini_lisp.core import Symbols, parse, get_symbols, RawLeaves, Ast
-from mini_lisp.core_types import Symbol, AstNode, AstLeaf, Variable, AstParent
+from mini_lisp.core_types import Symbol, AstNode, AstLeaf, Variable, is_parent
 from mini_lisp.patterns import PartialAst, match, MatchResult
+from mini_lisp.pattern_program import PatternProgram, compile_pattern, RhsTemplate, compile_template
 from mini_lisp.tree_utils import tree_replace, tree_display_short
 
 OPs = frozenset(Variable(x) for x in {'+', '-', '*', '/', '^', '<<'})
 
 AstP = AstNode[RawLeaves]
 DEBUG = False
+# part of the cache key, bump when Rule or PatternProgram change shape
+RULE_CACHE_VERSION = 3
 
 
 class RuleMatchResult(NamedTuple):
@@ -23,6 +30,10 @@ class Rule(NamedTuple):
     lhs: AstNode[AstLeaf]
     rhs: AstNode[AstLeaf]
     symbols: Symbols
+    # lhs compiled for the e-matching machine
+    program: PatternProgram
+    # rhs compiled to add its e-nodes without building an Ast
+    template: RhsTemplate
 
     @property
     def display(self):
@@ -45,10 +56,14 @@ class Rule(NamedTuple):
         symbol_keys -= frozenset(Variable(op) for op in custom_ops)
         to_symbol = {v: Symbol(i) for i, v in enumerate(symbol_keys)}
         symbols = Symbols.from_to_symbol(to_symbol)
+        lhs = tree_replace(ast_l, symbols.to_symbol, Variable, PartialAst)
+        rhs = tree_replace(ast_r, symbols.to_symbol, Variable, PartialAst)
         return Rule(
-            lhs=tree_replace(ast_l, symbols.to_symbol, Variable, PartialAst),
-            rhs=tree_replace(ast_r, symbols.to_symbol, Variable, PartialAst),
-            symbols=symbols
+            lhs=lhs,
+            rhs=rhs,
+            symbols=symbols,
+            program=compile_pattern(lhs),
+            template=compile_template(rhs),
         )
 
     def apply(self, match_result: MatchResult) -> RuleMatchResult:
@@ -74,6 +89,13 @@ class Rule(NamedTuple):
         return self.apply_all(match(self.lhs, ast))
 
 
+class RuleMatch(NamedTuple):
+    # a match kept as bindings, symbols map to classes (ClassRef) or operators
+    rule: Rule
+    class_id: int
+    symbols: Symbols
+
+
 # Examples:
 # """
 # (+ x 0) -> x
@@ -82,7 +104,30 @@ class Rule(NamedTuple):
 RuleSet = FrozenSet[Rule]
 
 
-def parse_ruleset(rules_str: str, trim: bool = False, custom_ops: Iterable[str] = tuple()) -> RuleSet:
+def ruleset_cache_key(rules_str: str, trim: bool, custom_ops: Iterable[str]) -> str:
+    source = repr((RULE_CACHE_VERSION, rules_str, trim, sorted(custom_ops)))
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def parse_ruleset(rules_str: str, trim: bool = False, custom_ops: Iterable[str] = tuple(),
+                  cache_dir: Optional[str] = None) -> RuleSet:
+    # with cache_dir, the compiled rules (patterns, programs and symbols) are pickled there keyed by
+    # the hash of the source, later calls with the same source skip parsing and compiling
+    if cache_dir is not None:
+        custom_ops = tuple(custom_ops)
+        path = os.path.join(cache_dir, ruleset_cache_key(rules_str, trim, custom_ops) + ".pickle")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        rules = parse_ruleset(rules_str, trim, custom_ops)
+        os.makedirs(cache_dir, exist_ok=True)
+        # written next to the target and renamed, so concurrent workers never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(rules, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return rules
+
     rules = set()
     for row in rules_str.split('\n'):
         if "->" in row:
@@ -100,6 +145,6 @@ def parse_ruleset(rules_str: str, trim: bool = False, custom_ops: Iterable[str]
 def trim_ruleset(rules: Iterable[Rule]) -> RuleSet:
     new_rules = frozenset(
         filter(lambda rule:
-               not (isinstance(rule.rhs, AstParent) and not isinstance(rule.lhs, AstParent)),
+               not (is_parent(rule.rhs) and not is_parent(rule.lhs)),
                rules))
     return new_rules
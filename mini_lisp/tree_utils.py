@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from typing import TypeVar, Mapping, Generator
 
-from mini_lisp.core_types import AstLeaf, AstNode, AstParent, Number, Symbol
+from mini_lisp.core_types import AstLeaf, AstNode, AstParent, Number, Symbol, is_parent
 
 MyMapping = Mapping
 
@@ -15,7 +15,7 @@ def tree_replace(ast,
                  table,
                  key_type,
                  dest_constructor):
-    if isinstance(ast, AstParent):
+    if is_parent(ast):
         args = []
         for arg in ast.args:
             args.append(tree_replace(arg, table, key_type, dest_constructor))
@@ -37,7 +37,7 @@ graph_last = '╙─ '
 def tree_display(tree: AstNode) -> str:
     # if isinstance(tree, AstParent):
     # recursive type.. sigh
-    if isinstance(tree, AstParent):
+    if is_parent(tree):
         return tree_parent_display(tree)
     else:
         return tree.display
@@ -50,7 +50,7 @@ def tree_parent_display(tree: AstParent[AstLeaf]) -> str:
 def tree_display_helper(tree: AstParent, prefix: str) -> Generator[str, str, None]:
     pointers = [graph_tee] * (len(tree.args) - 2) + [graph_last]
     for pointer, arg in zip(pointers, tree.args[1:]):
-        if isinstance(arg, AstParent):
+        if is_parent(arg):
             yield prefix + pointer + arg.args[0].display
             extension = graph_branch if pointer == graph_tee else graph_space
             # yield prefix + extension + "╽"
@@ -60,7 +60,7 @@ def tree_display_helper(tree: AstParent, prefix: str) -> Generator[str, str, Non
 
 
 def tree_display_short(tree: AstNode) -> str:
-    if isinstance(tree, AstParent):
+    if is_parent(tree):
         args = " ".join(tree_display_short(arg) for arg in tree.args)
         return f"({args})"
     else:
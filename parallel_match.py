@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import itertools
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Tuple, List, Dict, Optional, Iterable, Union
+
+from egraph import EGraph, ClassRef
+from match_egraph import MatchBackend, match_symbols
+from mini_lisp.core import Symbols, RawLeaves
+from mini_lisp.core_types import Symbol
+from mini_lisp.rules import Rule, RuleMatch
+from snapshot import EGraphSnapshot, SnapshotGraph
+
+# bindings of one match sorted by symbol, symbols map to classes or operators
+Binding = Tuple[Tuple[Symbol, Union[ClassRef, RawLeaves]], ...]
+
+_worker_rules: Tuple[Rule, ...] = ()
+# snapshot path -> the memory mapped snapshot opened from it, one per worker
+_worker_graph: Optional[Tuple[str, SnapshotGraph]] = None
+
+
+def _init_worker(rules: Tuple[Rule, ...]) -> None:
+    global _worker_rules
+    _worker_rules = rules
+
+
+def _load_graph(path: str) -> SnapshotGraph:
+    # opening maps the file, nodes are decoded only for the classes the worker's shards read
+    global _worker_graph
+    if _worker_graph is None or _worker_graph[0] != path:
+        if _worker_graph is not None:
+            _worker_graph[1].snapshot.close()
+        _worker_graph = (path, SnapshotGraph(EGraphSnapshot.open(path)))
+    return _worker_graph[1]
+
+
+def binding_key(binding: Binding) -> Tuple:
+    # total order on bindings, so merged results do not depend on hash seeds
+    return tuple((s.i, v.type, v.id if v.type == "class_ref" else 0, "" if v.type == "class_ref" else v.display)
+                 for s, v in binding)
+
+
+def _match_shard(path: str, rule_index: int, shard: int, n_shards: int,
+                 backend: MatchBackend) -> List[Tuple[int, Binding]]:
+    graph = _load_graph(path)
+    found = {(class_id, tuple(sorted(symbols.from_symbol.items(), key=lambda kv: kv[0].i)))
+             for class_id, symbols in match_symbols(graph, _worker_rules[rule_index], backend, (shard, n_shards))}
+    return sorted(found, key=lambda m: (m[0], binding_key(m[1])))
+
+
+@dataclass
+class ParallelMatcher:
+    # The read phase on a process pool. The graph is saved as a snapshot file once per graph version,
+    # every worker maps it once and matches (rule, shard) tasks on it, shards split the root classes by id.
+    # Results are merged in rule order, then by shard, class id and bindings, whichever worker finishes first
+    rules: Tuple[Rule, ...]
+    processes: Optional[int] = None
+    n_shards: int = 4
+    backend: MatchBackend = "compiled"
+    rule_index: Dict[Rule, int] = field(default_factory=dict)
+    pool: Optional[ProcessPoolExecutor] = None
+    tmp_dir: Optional[tempfile.TemporaryDirectory] = None
+    n_searches: int = 0
+    # (graph, version, path) of the last snapshot saved, searches of an unchanged graph reuse it
+    saved: Optional[Tuple[EGraph, int, str]] = None
+
+    def __post_init__(self):
+        self.rules = tuple(self.rules)
+        self.rule_index = {rule: i for i, rule in enumerate(self.rules)}
+
+    def start_(self) -> None:
+        # the pool outlives a search, workers are spawned and sent the rules once
+        if self.pool is None:
+            self.tmp_dir = tempfile.TemporaryDirectory()
+            self.pool = ProcessPoolExecutor(self.processes, initializer=_init_worker, initargs=(self.rules,))
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.tmp_dir.cleanup()
+            self.pool, self.tmp_dir, self.saved = None, None, None
+
+    def __enter__(self) -> ParallelMatcher:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def search(self, egraph: EGraph, rules: Iterable[Rule]) -> Dict[Rule, List[RuleMatch]]:
+        indices = []
+        for rule in rules:
+            if rule not in self.rule_index:
+                raise ValueError(f"Unknown rule: {rule}")
+            indices.append(self.rule_index[rule])
+        self.start_()
+        self.n_searches += 1
+        if self.saved is None or self.saved[0] is not egraph or self.saved[1] != egraph.version:
+            if self.saved is not None:
+                os.remove(self.saved[2])
+            path = os.path.join(self.tmp_dir.name, f"{self.n_searches}.egraph")
+            egraph.save(path)
+            self.saved = (egraph, egraph.version, path)
+        path = self.saved[2]
+        tasks = list(itertools.product(sorted(indices), range(self.n_shards)))
+        futures = [self.pool.submit(_match_shard, path, i, shard, self.n_shards, self.backend) for i, shard in tasks]
+        results: Dict[Rule, List[RuleMatch]] = {self.rules[i]: [] for i in sorted(indices)}
+        for (i, _), future in zip(tasks, futures):
+            rule = self.rules[i]
+            results[rule].extend(RuleMatch(rule, class_id, Symbols.from_from_symbol(dict(binding)))
+                                 for class_id, binding in future.result())
+        return results
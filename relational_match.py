@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import itertools
+from typing import NamedTuple, Tuple, List, Dict, Iterator, Optional, Union, Callable
+
+from egraph import EGraph, ENode, ClassRef
+from mini_lisp.core import Symbols
+from mini_lisp.core_types import Symbol, AstNode, AstLeaf, AstParent, is_parent
+from mini_lisp.rules import Rule
+
+# Relational e-matching (https://ztatlock.net/pubs/2022-popl-rematch/2022-popl-rematch.pdf):
+# every e-node (op, arity) is a row (class id, child class ids...) of the table for (op, arity),
+# a pattern is a conjunctive query over those tables with one variable per pattern node,
+# and generic join binds one variable at a time across every atom mentioning it.
+# Shared pattern symbols are join variables, so non-linear patterns are pruned as early as any other.
+
+# variables are ints, the pattern root is variable 0
+Var = int
+# (class id, child class ids...)
+Row = Tuple[int, ...]
+# nested dicts, one level per variable of an atom in join order, the innermost level maps to None
+Trie = Dict[int, Optional["Trie"]]
+
+
+class Atom(NamedTuple):
+    # op is a Symbol when it stands for an operator bound by the match
+    op: AstLeaf
+    arity: int
+    vars: Tuple[Var, ...]
+
+
+class ConjunctiveQuery(NamedTuple):
+    atoms: Tuple[Atom, ...]
+    # leaf constants, the variable must be the class of the leaf
+    constants: Tuple[Tuple[Var, AstLeaf], ...]
+    symbol_vars: Tuple[Tuple[Symbol, Var], ...]
+    n_vars: int
+
+    @property
+    def op_symbols(self) -> Tuple[Symbol, ...]:
+        return tuple(dict.fromkeys(a.op for a in self.atoms if isinstance(a.op, Symbol)))
+
+
+def compile_query(pattern: AstParent[AstLeaf]) -> ConjunctiveQuery:
+    atoms: List[Atom] = []
+    constants: List[Tuple[Var, AstLeaf]] = []
+    symbol_vars: Dict[Symbol, Var] = {}
+    n_vars = 1
+
+    def var_of(node: AstNode[AstLeaf]) -> Var:
+        nonlocal n_vars
+        if isinstance(node, Symbol) and node in symbol_vars:
+            return symbol_vars[node]
+        var = n_vars
+        n_vars += 1
+        if isinstance(node, Symbol):
+            symbol_vars[node] = var
+        elif is_parent(node):
+            visit(node, var)
+        else:
+            constants.append((var, node))
+        return var
+
+    def visit(node: AstParent[AstLeaf], var: Var) -> None:
+        args = tuple(var_of(arg) for arg in node.args[1:])
+        atoms.append(Atom(node.args[0], len(args), (var, *args)))
+
+    visit(pattern, 0)
+    return ConjunctiveQuery(tuple(atoms), tuple(constants), tuple(symbol_vars.items()), n_vars)
+
+
+def variable_order(query: ConjunctiveQuery) -> List[Var]:
+    # variables in more atoms first, they prune the most, ties in pattern order
+    counts = [0] * query.n_vars
+    for atom in query.atoms:
+        for var in set(atom.vars):
+            counts[var] += 1
+    for var, _ in query.constants:
+        counts[var] += 1
+    return sorted(range(query.n_vars), key=lambda v: -counts[v])
+
+
+def table(graph: EGraph, op: AstLeaf, arity: int) -> List[Row]:
+    return [(class_id, *(graph.find(a) for a in node.args))
+            for class_id in graph.classes_with_op(op, arity)
+            for node in graph.classes[class_id]
+            if node.op == op and len(node.args) == arity]
+
+
+def build_trie(rows: List[Row], atom_vars: Tuple[Var, ...], rank: Dict[Var, int]) -> Tuple[Trie, Tuple[Var, ...]]:
+    # one trie level per distinct variable in join order, rows repeating a variable must agree on it
+    order = tuple(sorted(set(atom_vars), key=rank.__getitem__))
+    first = {var: atom_vars.index(var) for var in order}
+    repeats = [(i, first[var]) for i, var in enumerate(atom_vars) if first[var] != i]
+    trie: Trie = {}
+    for row in rows:
+        if any(row[i] != row[j] for i, j in repeats):
+            continue
+        level = trie
+        for var in order[:-1]:
+            level = level.setdefault(row[first[var]], {})
+        level[row[first[order[-1]]]] = None
+    return trie, order
+
+
+def generic_join(tries: List[Tuple[Trie, Tuple[Var, ...]]], order: List[Var],
+                 keep_root: Optional[Callable[[int], bool]]) -> Iterator[List[int]]:
+    # binds order[depth] to every value present in all tries mentioning it, then descends in those tries
+    by_var: Dict[Var, List[int]] = {var: [] for var in order}
+    for i, (_, vars_) in enumerate(tries):
+        for var in vars_:
+            by_var[var].append(i)
+    position: List[Optional[Trie]] = [trie for trie, _ in tries]
+    binding = [0] * len(order)
+
+    def join(depth: int) -> Iterator[List[int]]:
+        if depth == len(order):
+            yield binding
+            return
+        var = order[depth]
+        levels = [position[i] for i in by_var[var]]
+        smallest = min(levels, key=len)
+        for value in smallest:
+            if var == 0 and keep_root is not None and not keep_root(value):
+                continue
+            if any(value not in level for level in levels if level is not smallest):
+                continue
+            saved = [position[i] for i in by_var[var]]
+            for i in by_var[var]:
+                position[i] = position[i][value]
+            binding[var] = value
+            yield from join(depth + 1)
+            for i, level in zip(by_var[var], saved):
+                position[i] = level
+
+    yield from join(0)
+
+
+def op_assignments(graph: EGraph, query: ConjunctiveQuery) -> Iterator[Dict[Symbol, AstLeaf]]:
+    # an operator symbol can be any op present with every arity it is used with
+    candidates = []
+    for symbol in query.op_symbols:
+        arities = {a.arity for a in query.atoms if a.op == symbol}
+        ops = {op for op, arity in graph.op_index if arity in arities}
+        candidates.append([op for op in ops if all(len(graph.classes_with_op(op, n)) > 0 for n in arities)])
+    for ops in itertools.product(*candidates):
+        yield dict(zip(query.op_symbols, ops))
+
+
+def match_relational(graph: EGraph, rule: Rule,
+                     keep_root: Optional[Callable[[int], bool]] = None) -> Iterator[Tuple[int, Symbols]]:
+    # (class id, bindings) of every distinct match, keep_root filters the classes matches are rooted at
+    if not rule.program.matchable:
+        return
+    query = compile_query(rule.lhs)
+    order = variable_order(query)
+    rank = {var: i for i, var in enumerate(order)}
+    constant_tries = []
+    for var, leaf in query.constants:
+        class_id = graph.lookup(ENode(leaf))
+        if class_id is None:
+            return
+        constant_tries.append(({class_id: None}, (var,)))
+    for ops in op_assignments(graph, query):
+        tries = list(constant_tries)
+        for atom in query.atoms:
+            op = ops.get(atom.op, atom.op) if isinstance(atom.op, Symbol) else atom.op
+            tries.append(build_trie(table(graph, op, atom.arity), atom.vars, rank))
+        seen = set()
+        for binding in generic_join(tries, order, keep_root):
+            # variables of inner pattern nodes are projected out, which can repeat a match
+            key = (binding[0], tuple(binding[v] for _, v in query.symbol_vars))
+            if key in seen:
+                continue
+            seen.add(key)
+            from_symbol: Dict[Symbol, Union[ClassRef, AstLeaf]] = {s: ClassRef(binding[v]) for s, v in query.symbol_vars}
+            from_symbol.update(ops)
+            yield binding[0], Symbols.from_from_symbol(from_symbol)
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from enum import Enum, auto
+from typing import List, Optional, Callable, NamedTuple, Dict, Set
+
+from egraph import EGraph
+from match_egraph import MatchBackend, search_matches
+from mini_lisp.pattern_program import pattern_height
+from mini_lisp.rules import RuleSet, RuleMatch, Rule
+from parallel_match import ParallelMatcher
+from scheduler import Scheduler, SimpleScheduler
+
+
+class StopReason(Enum):
+    Saturated = auto()
+    IterationLimit = auto()
+    NodeLimit = auto()
+    TimeLimit = auto()
+
+
+class Iteration(NamedTuple):
+    n_matches: int
+    n_nodes: int
+    n_classes: int
+    search_time: float
+    apply_time: float
+    rebuild_time: float
+    # False when only classes near the ones changed by the previous iteration were searched
+    full_pass: bool = True
+
+
+@dataclass
+class Runner:
+    # Saturation in batches: every iteration matches all rules against the unchanged graph (read phase),
+    # applies every match (write phase) and then rebuilds once
+    # limits set to None are not checked
+    egraph: EGraph
+    iter_limit: Optional[int] = 30
+    node_limit: Optional[int] = 10_000
+    time_limit: Optional[float] = 5.0
+    backend: MatchBackend = "compiled"
+    scheduler: Scheduler = field(default_factory=SimpleScheduler)
+    # matches on a process pool when set, its backend is used instead of backend
+    parallel: Optional[ParallelMatcher] = None
+    # semi-naive matching: a rule whose matches were all applied last iteration is only searched at
+    # classes within its pattern height above a class created or merged since, every full_pass_every
+    # iterations and before declaring saturation every rule is searched everywhere (serial matching only)
+    incremental: bool = False
+    full_pass_every: int = 10
+    # rule -> last iteration every match of it was applied
+    complete: Dict[Rule, int] = field(default_factory=dict)
+    # called with the runner after every iteration
+    hooks: List[Callable[[Runner], None]] = field(default_factory=list)
+    iterations: List[Iteration] = field(default_factory=list)
+    stop_reason: Optional[StopReason] = None
+
+    def check_limits(self, start_time: float) -> Optional[StopReason]:
+        if self.iter_limit is not None and len(self.iterations) >= self.iter_limit:
+            return StopReason.IterationLimit
+        return self.check_budget(start_time)
+
+    def check_budget(self, start_time: float) -> Optional[StopReason]:
+        # the limits one iteration can cross, also checked after every rule's search and every applied match
+        if self.node_limit is not None and self.egraph.n_nodes > self.node_limit:
+            return StopReason.NodeLimit
+        if self.time_limit is not None and time.perf_counter() - start_time > self.time_limit:
+            return StopReason.TimeLimit
+        return None
+
+    def search(self, rule_set: RuleSet, full_pass: bool = True, start_time: Optional[float] = None) -> List[RuleMatch]:
+        # with start_time, stops within the rule whose search crosses the time limit
+        iteration = len(self.iterations)
+        deadline = None
+        if start_time is not None and self.time_limit is not None:
+            deadline = start_time + self.time_limit
+        dirty = self.egraph.take_dirty_()
+        rules = [rule for rule in rule_set if self.scheduler.should_search(iteration, rule)]
+        if self.parallel is not None:
+            found = self.parallel.search(self.egraph, rules)
+        else:
+            found = {}
+            # height -> classes a new match can be rooted at
+            roots: Dict[int, Set[int]] = {}
+            for rule in rules:
+                if full_pass or self.complete.get(rule) != iteration - 1:
+                    found[rule] = search_matches(self.egraph, rule, self.backend, deadline=deadline)
+                else:
+                    height = pattern_height(rule.lhs)
+                    if height not in roots:
+                        roots[height] = self.egraph.ancestors(dirty, height)
+                    found[rule] = search_matches(self.egraph, rule, self.backend, roots[height], deadline)
+                if start_time is not None and self.check_budget(start_time) is not None:
+                    break
+        results = []
+        for rule, matches in found.items():
+            kept = self.scheduler.filter_matches(iteration, rule, matches)
+            if len(kept) == len(matches):
+                self.complete[rule] = iteration
+            results.extend(kept)
+        return results
+
+    def run(self, rule_set: RuleSet) -> StopReason:
+        start_time = time.perf_counter()
+        confirm = False
+        while True:
+            stop_reason = self.check_limits(start_time)
+            if stop_reason is not None:
+                break
+
+            iteration = len(self.iterations)
+            full_pass = not self.incremental or confirm or iteration % self.full_pass_every == 0
+            search_start = time.perf_counter()
+            results = self.search(rule_set, full_pass, start_time)
+            stop_reason = self.check_budget(start_time)
+            if stop_reason is not None:
+                # some rules were not searched and the dirty classes are taken, the next run searches everywhere
+                self.complete.clear()
+                break
+            apply_start = time.perf_counter()
+            version = self.egraph.version
+            for result in results:
+                self.egraph.apply_match_(result)
+                stop_reason = self.check_budget(start_time)
+                if stop_reason is not None:
+                    # the rest of the matches stay unapplied, rebuild and stop after recording the iteration
+                    self.complete.clear()
+                    break
+            rebuild_start = time.perf_counter()
+            self.egraph.rebuild()
+            self.iterations.append(Iteration(
+                n_matches=len(results),
+                n_nodes=self.egraph.n_nodes,
+                n_classes=len(self.egraph.classes),
+                search_time=apply_start - search_start,
+                apply_time=rebuild_start - apply_start,
+                rebuild_time=time.perf_counter() - rebuild_start,
+                full_pass=full_pass,
+            ))
+            for hook in self.hooks:
+                hook(self)
+            if stop_reason is not None:
+                break
+            confirm = False
+            if self.egraph.version == version:
+                if not full_pass:
+                    # the safety net: only a full pass finding nothing proves saturation
+                    confirm = True
+                elif self.scheduler.can_stop(iteration):
+                    stop_reason = StopReason.Saturated
+                    break
+
+        self.stop_reason = stop_reason
+        return stop_reason
+
+
+def saturate(egraph: EGraph, rule_set: RuleSet, visualize_lvl: int = 0, max_iter: int = 200) -> StopReason:
+    # writes are batched per iteration, so every visualize_lvl above 0 views the graph once per iteration
+    runner = Runner(egraph, iter_limit=max_iter, node_limit=None, time_limit=None)
+    if visualize_lvl > 0:
+        runner.hooks.append(lambda r: r.egraph.to_mermaid().view_())
+    return runner.run(rule_set)
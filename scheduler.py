@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+from abc import abstractmethod
+from dataclasses import dataclass, field
+from typing import Protocol, Dict, Collection
+
+from mini_lisp.rules import Rule, RuleMatch
+
+
+class Scheduler(Protocol):
+    # whether rule is searched at all this iteration
+    @abstractmethod
+    def should_search(self, iteration: int, rule: Rule) -> bool: ...
+
+    # sees every match of a searched rule, returns the ones to apply
+    @abstractmethod
+    def filter_matches(self, iteration: int, rule: Rule,
+                       matches: Collection[RuleMatch]) -> Collection[RuleMatch]: ...
+
+    # asked when an iteration changed nothing, a scheduler holding rules back can refuse
+    @abstractmethod
+    def can_stop(self, iteration: int) -> bool: ...
+
+
+class SimpleScheduler:
+    # every rule, every iteration
+    def should_search(self, iteration: int, rule: Rule) -> bool:
+        return True
+
+    def filter_matches(self, iteration: int, rule: Rule,
+                       matches: Collection[RuleMatch]) -> Collection[RuleMatch]:
+        return matches
+
+    def can_stop(self, iteration: int) -> bool:
+        return True
+
+
+@dataclass
+class RuleStats:
+    times_fired: int = 0
+    times_banned: int = 0
+    banned_until: int = 0
+
+
+@dataclass
+class BackoffScheduler:
+    # egg's backoff: a rule matching more than match_limit << times_banned times is banned
+    # for ban_length << times_banned iterations, so explosive rules like commutativity
+    # and associativity can not starve the others
+    match_limit: int = 1000
+    ban_length: int = 5
+    stats: Dict[Rule, RuleStats] = field(default_factory=dict)
+
+    def should_search(self, iteration: int, rule: Rule) -> bool:
+        return iteration >= self.stats.setdefault(rule, RuleStats()).banned_until
+
+    def filter_matches(self, iteration: int, rule: Rule,
+                       matches: Collection[RuleMatch]) -> Collection[RuleMatch]:
+        stats = self.stats.setdefault(rule, RuleStats())
+        threshold = self.match_limit << stats.times_banned
+        if len(matches) > threshold:
+            stats.banned_until = iteration + (self.ban_length << stats.times_banned)
+            stats.times_banned += 1
+            return frozenset()
+        stats.times_fired += len(matches)
+        return matches
+
+    def can_stop(self, iteration: int) -> bool:
+        banned = [s for s in self.stats.values() if s.banned_until > iteration]
+        if len(banned) == 0:
+            return True
+        # nothing else to do, bring the next banned rules back right away
+        delta = min(s.banned_until for s in banned) - iteration
+        for s in banned:
+            s.banned_until -= delta
+        return False
@@ -0,0 +1,417 @@
+from __future__ import annotations
+
+import mmap
+import operator
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from itertools import chain, repeat
+from typing import List, Sequence, Optional, Dict, Any, Tuple, FrozenSet, Iterator, Set, Type
+
+from compact_egraph import CompactEGraph, NONE
+from egraph import EGraph, ENode, UnionFind, FINGERPRINT_MASK
+from mini_lisp.core import RawLeaves
+from mini_lisp.core_types import Number, Variable
+
+# File layout, every int section is int32 in native byte order:
+#   header
+#   op_ids[n_nodes]              string table index of every node's op, nodes are grouped by class
+#   child_offsets[n_nodes + 1]   node i's children are children[child_offsets[i]:child_offsets[i + 1]]
+#   children[n_children]         canonical child class ids
+#   class_ids[n_classes]         canonical class ids, ascending
+#   class_offsets[n_classes + 1] class j holds nodes class_offsets[j]:class_offsets[j + 1]
+#   uf_parents[n_ids + 1]        union find parents, index 0 is unused
+#   uf_sizes[n_ids + 1]          set sizes at the roots, 0 elsewhere
+#   roots[n_roots]
+#   group_ops[n_groups]          the op index: string index and arity of every (op, arity) group,
+#   group_arities[n_groups]      ascending, the group holds group_classes[group_offsets[g]:group_offsets[g + 1]],
+#   group_offsets[n_groups + 1]  the ascending ids of the classes with such a node
+#   group_classes[n_group_classes]
+#   leaf_kinds[n_strings]        0: variable name, 1: int, 2: float
+#   string_offsets[n_strings + 1]
+#   utf-8 string bytes, strings are sorted by (kind, bytes) so a leaf is found by bisection
+MAGIC = b"EGRAPH03"
+# the fingerprint is not saved, it is built from hash() values that only hold within one process
+HEADER = struct.Struct("<8s?10iq")
+SECTIONS = ("op_ids", "child_offsets", "children", "class_ids", "class_offsets", "uf_parents", "uf_sizes", "roots",
+            "group_ops", "group_arities", "group_offsets", "group_classes", "leaf_kinds", "string_offsets")
+assert array("i").itemsize == 4
+
+
+def encode_leaf(leaf: RawLeaves) -> Tuple[int, str]:
+    if leaf.type == "variable":
+        return 0, leaf.name
+    elif isinstance(leaf.value, int):
+        return 1, str(leaf.value)
+    else:
+        return 2, repr(leaf.value)
+
+
+def decode_leaf(kind: int, text: str) -> RawLeaves:
+    if kind == 0:
+        return Variable(text)
+    elif kind == 1:
+        return Number(int(text))
+    elif kind == 2:
+        return Number(float(text))
+    else:
+        raise ValueError(f"Unknown leaf kind: {kind}")
+
+
+def save_egraph(graph: EGraph, path: str) -> None:
+    if len(graph.pending) > 0:
+        raise RuntimeError("Graph has merges pending, rebuild it before saving")
+    sections = {name: array("i") for name in SECTIONS}
+    ops = {node.op for nodes in graph.classes.values() for node in nodes}
+    encoded = sorted(((encode_leaf(op), op) for op in ops), key=lambda e: e[0])
+    string_ids: Dict[RawLeaves, int] = {op: i for i, (_, op) in enumerate(encoded)}
+    # (string id, arity) -> classes
+    groups: Dict[Tuple[int, int], Set[int]] = {}
+    sections["child_offsets"].append(0)
+    sections["class_offsets"].append(0)
+    op_ids, children, child_offsets = sections["op_ids"], sections["children"], sections["child_offsets"]
+    for class_id in sorted(graph.classes):
+        sections["class_ids"].append(class_id)
+        for node in graph.classes[class_id]:
+            string_id = string_ids[node.op]
+            op_ids.append(string_id)
+            # rebuilt, so children are canonical
+            children.extend(node.args)
+            child_offsets.append(len(children))
+            groups.setdefault((string_id, len(node.args)), set()).add(class_id)
+        sections["class_offsets"].append(len(op_ids))
+    uf = graph.uf
+    sections["uf_parents"].append(0)
+    sections["uf_parents"].extend(uf.parents[i] for i in range(1, uf.n_ids + 1))
+    sections["uf_sizes"].append(0)
+    sections["uf_sizes"].extend(uf.sizes[i] if uf.parents[i] == i else 0 for i in range(1, uf.n_ids + 1))
+    sections["roots"].extend(graph.find(r) for r in graph.roots)
+    sections["group_offsets"].append(0)
+    for (string_id, arity), class_ids in sorted(groups.items()):
+        sections["group_ops"].append(string_id)
+        sections["group_arities"].append(arity)
+        sections["group_classes"].extend(sorted(class_ids))
+        sections["group_offsets"].append(len(sections["group_classes"]))
+
+    strings = bytearray()
+    sections["string_offsets"].append(0)
+    for (kind, text), _ in encoded:
+        sections["leaf_kinds"].append(kind)
+        strings += text.encode()
+        sections["string_offsets"].append(len(strings))
+
+    header = HEADER.pack(
+        MAGIC, sys.byteorder == "little",
+        len(string_ids), len(sections["op_ids"]), len(sections["children"]), len(sections["class_ids"]),
+        uf.n_ids, len(sections["roots"]), len(sections["group_ops"]), len(sections["group_classes"]),
+        -1 if graph.root_class is None else graph.find(graph.root_class), len(strings),
+        graph.version,
+    )
+    with open(path, "wb") as f:
+        f.write(header)
+        for name in SECTIONS:
+            sections[name].tofile(f)
+        f.write(strings)
+
+
+def copy_ints(view: memoryview) -> array:
+    # one copy of the bytes, no Python int per element
+    ints = array("i")
+    ints.frombytes(view.cast("B"))
+    return ints
+
+
+@dataclass
+class EGraphSnapshot:
+    # A saved graph read in place: the int sections are views into the file (or any buffer),
+    # nodes become Python objects only when they are asked for
+    op_ids: Sequence[int]
+    child_offsets: Sequence[int]
+    children: Sequence[int]
+    class_ids: Sequence[int]
+    class_offsets: Sequence[int]
+    uf_parents: Sequence[int]
+    uf_sizes: Sequence[int]
+    roots: Sequence[int]
+    group_ops: Sequence[int]
+    group_arities: Sequence[int]
+    group_offsets: Sequence[int]
+    group_classes: Sequence[int]
+    leaf_kinds: Sequence[int]
+    string_offsets: Sequence[int]
+    strings: Sequence[int]
+    root_class: Optional[int]
+    version: int
+    # keeps the mapping alive for the views above
+    buffer: Any = field(default=None, repr=False)
+    # string table index -> decoded op
+    ops: Dict[int, RawLeaves] = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_buffer(cls, buffer, keep: Any = None) -> EGraphSnapshot:
+        (magic, little, n_strings, n_nodes, n_children, n_classes, n_ids, n_roots, n_groups, n_group_classes,
+         root_class, n_bytes, version) = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Unknown snapshot format: {magic!r}")
+        if little != (sys.byteorder == "little"):
+            raise ValueError("Snapshot was saved with a different byte order")
+        sizes = (n_nodes, n_nodes + 1, n_children, n_classes, n_classes + 1, n_ids + 1, n_ids + 1, n_roots,
+                 n_groups, n_groups, n_groups + 1, n_group_classes, n_strings, n_strings + 1)
+        view = memoryview(buffer)
+        offset = HEADER.size
+        sections = {}
+        for name, size in zip(SECTIONS, sizes):
+            sections[name] = view[offset:offset + 4 * size].cast("i")
+            offset += 4 * size
+        return cls(**sections, strings=view[offset:offset + n_bytes],
+                   root_class=None if root_class == -1 else root_class,
+                   version=version, buffer=keep)
+
+    @classmethod
+    def open(cls, path: str) -> EGraphSnapshot:
+        # memory mapped, pages are read from disk when they are touched
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(mapped, keep=mapped)
+
+    def close(self) -> None:
+        # views must be released before the mapping can be closed
+        for name in SECTIONS + ("strings",):
+            getattr(self, name).release()
+        if self.buffer is not None:
+            self.buffer.close()
+
+    def __enter__(self) -> EGraphSnapshot:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.op_ids)
+
+    @property
+    def n_classes(self) -> int:
+        return len(self.class_ids)
+
+    def find(self, class_id: int) -> int:
+        # read only, so no path compression
+        while self.uf_parents[class_id] != class_id:
+            class_id = self.uf_parents[class_id]
+        return class_id
+
+    def op(self, string_id: int) -> RawLeaves:
+        op = self.ops.get(string_id)
+        if op is None:
+            text = bytes(self.strings[self.string_offsets[string_id]:self.string_offsets[string_id + 1]]).decode()
+            op = self.ops[string_id] = decode_leaf(self.leaf_kinds[string_id], text)
+        return op
+
+    def string_key(self, string_id: int) -> Tuple[int, bytes]:
+        return (self.leaf_kinds[string_id],
+                bytes(self.strings[self.string_offsets[string_id]:self.string_offsets[string_id + 1]]))
+
+    def string_id(self, leaf: RawLeaves) -> Optional[int]:
+        # bisection over the sorted string table, nothing is decoded
+        kind, text = encode_leaf(leaf)
+        key = (kind, text.encode())
+        lo, hi = 0, len(self.leaf_kinds)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self.leaf_kinds) and self.string_key(lo) == key else None
+
+    def group(self, string_id: int, arity: int) -> Optional[int]:
+        # index of the (op, arity) group, a string has one group per arity it is used with
+        g = bisect_left(self.group_ops, string_id)
+        while g < len(self.group_ops) and self.group_ops[g] == string_id:
+            if self.group_arities[g] == arity:
+                return g
+            g += 1
+        return None
+
+    def group_class_ids(self, g: int) -> Sequence[int]:
+        return self.group_classes[self.group_offsets[g]:self.group_offsets[g + 1]]
+
+    def all_ops(self) -> List[RawLeaves]:
+        # the whole string table decoded at once, string index -> op
+        strings, offsets = bytes(self.strings), self.string_offsets.tolist()
+        texts = map(bytes.decode, map(strings.__getitem__, map(slice, offsets[:-1], offsets[1:])))
+        return list(map(decode_leaf, self.leaf_kinds, texts))
+
+    def node(self, i: int) -> ENode:
+        children = self.children[self.child_offsets[i]:self.child_offsets[i + 1]]
+        return ENode(self.op(self.op_ids[i]), tuple(children))
+
+    def class_nodes(self, class_id: int) -> List[ENode]:
+        class_id = self.find(class_id)
+        j = bisect_left(self.class_ids, class_id)
+        if j == len(self.class_ids) or self.class_ids[j] != class_id:
+            raise ValueError(f"Unknown class: {class_id}")
+        return [self.node(i) for i in range(self.class_offsets[j], self.class_offsets[j + 1])]
+
+    def to_egraph(self) -> EGraph:
+        # every node becomes an ENode in the dicts of EGraph, O(n) in Python
+        graph = EGraph.empty()
+        uf_parents, uf_sizes = self.uf_parents.tolist(), self.uf_sizes.tolist()
+        graph.uf = UnionFind({i: uf_parents[i] for i in range(1, len(uf_parents))},
+                             {i: uf_sizes[i] for i in range(1, len(uf_parents)) if uf_parents[i] == i})
+        graph.parents = {class_id: array("i") for class_id in self.class_ids}
+        for j, class_id in enumerate(self.class_ids):
+            nodes = [self.node(i) for i in range(self.class_offsets[j], self.class_offsets[j + 1])]
+            graph.classes[class_id] = set(nodes)
+            for node in nodes:
+                graph.registry[node] = class_id
+                for arg in dict.fromkeys(node.args):
+                    graph.parents[arg].append(len(graph.nodes))
+                graph.nodes.append(node)
+                graph.node_classes.append(class_id)
+        for g in range(len(self.group_ops)):
+            graph.op_index[(self.op(self.group_ops[g]), self.group_arities[g])] = set(self.group_class_ids(g))
+        graph.roots = list(self.roots)
+        graph.root_class = self.root_class
+        graph.version = self.version
+        # recomputed in this process from the structure, new nodes and merges then add to it as usual
+        graph.fingerprint = sum(hash((node, class_id)) for node, class_id in graph.registry.items()) & FINGERPRINT_MASK
+        return graph
+
+    def to_compact_egraph(self) -> CompactEGraph:
+        # The int columns are copied as bytes, the hashcons, the use chains and the fingerprint are
+        # rebuilt from them, still O(n) in Python but without an ENode per node.
+        # Node ids, parent order and class ids are the ones to_egraph gives, so both graphs take the same steps
+        graph = CompactEGraph()
+        table, eclasses = graph.table, graph.eclasses
+        n_nodes, n_ids = self.n_nodes, len(self.uf_parents) - 1
+        table.ops = self.all_ops()
+        table.op_ids = {op: i for i, op in enumerate(table.ops)}
+        table.node_ops = copy_ints(self.op_ids)
+        table.child_offsets = copy_ints(self.child_offsets)
+        table.children = copy_ints(self.children)
+        sizes = map(operator.sub, self.class_offsets[1:], self.class_offsets[:-1])
+        table.node_classes = array("i", chain.from_iterable(map(repeat, self.class_ids, sizes)))
+        # the children of every node, shared by the hashcons, the use chains and the fingerprint
+        node_args = list(map(tuple, map(self.children.__getitem__,
+                                        map(slice, self.child_offsets[:-1], self.child_offsets[1:]))))
+        table.fill_(map(hash, zip(table.node_ops, node_args)))
+
+        eclasses.first_node = array("i", [NONE]) * (n_ids + 1)
+        eclasses.last_node = array("i", [NONE]) * (n_ids + 1)
+        eclasses.next_node = array("i", range(1, n_nodes + 1))
+        for class_id, start, end in zip(self.class_ids, self.class_offsets, self.class_offsets[1:]):
+            eclasses.first_node[class_id], eclasses.last_node[class_id] = start, end - 1
+            eclasses.next_node[end - 1] = NONE
+        eclasses.first_use = array("i", [NONE]) * (n_ids + 1)
+        eclasses.last_use = array("i", [NONE]) * (n_ids + 1)
+        for node_id, args in enumerate(node_args):
+            for arg in dict.fromkeys(args):
+                eclasses.add_use_(arg, node_id)
+
+        graph.uf.parents = copy_ints(self.uf_parents)
+        graph.uf.sizes = copy_ints(self.uf_sizes)
+        graph.n_classes = self.n_classes
+        for g in range(len(self.group_ops)):
+            if self.group_arities[g] > 0:
+                graph.op_index[(table.ops[self.group_ops[g]], self.group_arities[g])] = set(self.group_class_ids(g))
+        graph.roots = list(self.roots)
+        graph.root_class = self.root_class
+        graph.version = self.version
+        # the same sum as to_egraph, an ENode hashes like the tuple of its fields
+        nodes = zip(map(table.ops.__getitem__, table.node_ops), node_args)
+        graph.fingerprint = sum(map(hash, zip(nodes, table.node_classes))) & FINGERPRINT_MASK
+        return graph
+
+
+class SnapshotClasses(Mapping):
+    # canonical id -> nodes of the class, decoded on first access
+    def __init__(self, snapshot: EGraphSnapshot):
+        self.snapshot = snapshot
+        self.decoded: Dict[int, FrozenSet[ENode]] = {}
+
+    def __getitem__(self, class_id: int) -> FrozenSet[ENode]:
+        nodes = self.decoded.get(class_id)
+        if nodes is None:
+            if self.snapshot.find(class_id) != class_id:
+                raise KeyError(class_id)
+            nodes = self.decoded[class_id] = frozenset(self.snapshot.class_nodes(class_id))
+        return nodes
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.snapshot.class_ids)
+
+    def __len__(self) -> int:
+        return self.snapshot.n_classes
+
+
+class SnapshotOpIndex(Mapping):
+    # (op, arity) -> ids of the classes holding such a node, read from the op index sections on first access.
+    # Like CompactEGraph.op_index, leaves are left out
+    def __init__(self, snapshot: EGraphSnapshot):
+        self.snapshot = snapshot
+        self.decoded: Dict[Tuple[RawLeaves, int], Set[int]] = {}
+
+    def __getitem__(self, key: Tuple[RawLeaves, int]) -> Set[int]:
+        class_ids = self.decoded.get(key)
+        if class_ids is None:
+            op, arity = key
+            string_id = None if arity == 0 else self.snapshot.string_id(op)
+            g = None if string_id is None else self.snapshot.group(string_id, arity)
+            if g is None:
+                raise KeyError(key)
+            class_ids = self.decoded[key] = set(self.snapshot.group_class_ids(g))
+        return class_ids
+
+    def __iter__(self) -> Iterator[Tuple[RawLeaves, int]]:
+        snapshot = self.snapshot
+        return ((snapshot.op(snapshot.group_ops[g]), snapshot.group_arities[g])
+                for g in range(len(snapshot.group_ops)) if snapshot.group_arities[g] > 0)
+
+    def __len__(self) -> int:
+        return sum(1 for arity in self.snapshot.group_arities if arity > 0)
+
+
+class SnapshotGraph:
+    # Read only view of a snapshot with the part of the EGraph interface matching uses:
+    # find, lookup, classes, classes_with_op and op_index. Nothing is built up front,
+    # classes and op index entries are decoded from the mapped sections when a matcher reads them
+    def __init__(self, snapshot: EGraphSnapshot):
+        self.snapshot = snapshot
+        self.root_class = snapshot.root_class
+        self.classes = SnapshotClasses(snapshot)
+        self.op_index = SnapshotOpIndex(snapshot)
+
+    def find(self, class_id: int) -> int:
+        return self.snapshot.find(class_id)
+
+    def leaf_class(self, leaf: RawLeaves) -> Optional[int]:
+        # a leaf is in one class, the only one of its arity 0 group
+        string_id = self.snapshot.string_id(leaf)
+        g = None if string_id is None else self.snapshot.group(string_id, 0)
+        return None if g is None else self.snapshot.group_class_ids(g)[0]
+
+    def classes_with_op(self, op: RawLeaves, arity: int) -> Set[int]:
+        if arity == 0:
+            class_id = self.leaf_class(op)
+            return set() if class_id is None else {class_id}
+        return self.op_index.get((op, arity), set())
+
+    def lookup(self, node: ENode) -> Optional[int]:
+        if len(node.args) == 0:
+            return self.leaf_class(node.op)
+        node = ENode(node.op, tuple(self.find(a) for a in node.args))
+        for class_id in self.classes_with_op(node.op, len(node.args)):
+            if node in self.classes[class_id]:
+                return class_id
+        return None
+
+
+def load_egraph(path: str, cls: Type[EGraph] = EGraph) -> EGraph:
+    with open(path, "rb") as f:
+        snapshot = EGraphSnapshot.from_buffer(f.read())
+    return snapshot.to_compact_egraph() if issubclass(cls, CompactEGraph) else snapshot.to_egraph()
@@ -1,11 +1,18 @@
 from __future__ import annotations
 
+import io
+import os
+import tempfile
 from pprint import pprint
 
-from egraph import EGraph
-from match_egraph import match_rule
+from compact_egraph import CompactEGraph
+from egraph import EGraph, ENode
+from match_egraph import match_rule, search_matches
+from runner import Runner
 from mini_lisp.core import parse
-from mini_lisp.rules import Rule
+from mini_lisp.core_types import Variable
+from mini_lisp.rules import Rule, parse_ruleset
+from snapshot import EGraphSnapshot, SnapshotGraph
 
 example2 = "(/ (* a 2) 2)"
 g = EGraph.from_ast(parse(example2))
@@ -59,3 +66,132 @@ g.apply_(next_res)
 print(g)
 print(g.to_mermaid().display())
 g.to_mermaid().view_()
+
+# congruence: merging a and b must merge (+ a 1) and (+ b 1) after rebuild
+g = EGraph.from_ast(parse("(* (+ a 1) (+ b 1))"))
+assert len(g.classes) == 6
+g.apply_(next(iter(match_rule(g, Rule.parse('a', 'b', custom_ops=['a', 'b'])))))
+assert len(g.classes) == 5
+g.rebuild()
+assert len(g.classes) == 4
+assert len(g.root_nodes) == 1
+print(next(iter(g.root_nodes)).display)
+
+# all bindings: the class of (* a 2) also holds (<< a 1), so a symbol operator matches twice
+g = EGraph.from_ast(parse("(- (* a 2))"))
+g.apply_(next(iter(match_rule(g, Rule.parse('(* x 2)', '(<< x 1)')))))
+g.rebuild()
+res = match_rule(g, Rule.parse('(- (o x y))', '(o y x)'))
+assert len(res) == 2
+[print(r.display()) for r in res]
+
+# compiled patterns give the same matches as the recursive matcher
+rule = Rule.parse('(- (o x y))', '(o y x)')
+print(rule.program.display)
+assert match_rule(g, rule, "compiled") == match_rule(g, rule, "recursive")
+
+# several expressions read lazily into one graph, shared subterms are deduplicated
+g = EGraph.empty()
+roots = g.add_exprs(io.StringIO("(+ a 1)\n(* (+ a 1)\n   2)\n(+ a 1)"))
+assert roots[0] == roots[2] == g.root_class
+assert len(g.classes) == 5
+assert g.add_expr("(* (+ a 1) 2)") == roots[1]
+assert g.roots == roots + [roots[1]]
+
+# deep terms load without hitting the recursion limit, from an Ast and from the streaming reader
+deep = EGraph.from_ast(parse("(- " * 50_000 + "x" + ")" * 50_000))
+assert deep.n_nodes == len(deep.classes) == 50_001
+streamed = CompactEGraph.empty()
+assert streamed.add_exprs(["(- " * 5_000 + "x" + ")" * 5_000]) == [streamed.root_class] and streamed.n_nodes == 5_001
+
+# binary snapshots round trip, the memory mapped view reads nodes in place
+g.add_expr("(+ 1.5 (- 2))")
+g.apply_(next(iter(match_rule(g, Rule.parse('(+ x 1)', '(+ 1 x)')))))
+g.rebuild()
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "g.egraph")
+    g.save(path)
+    loaded = EGraph.load(path)
+    assert loaded.classes == g.classes and loaded.roots == [g.find(r) for r in g.roots]
+    # the fingerprint is not saved, a loaded graph gets one from its structure
+    assert hash(loaded) == hash(EGraph.load(path))
+    with EGraphSnapshot.open(path) as snapshot:
+        assert set(snapshot.class_nodes(g.root_class)) == g.root_nodes
+        assert snapshot.to_egraph().registry == loaded.registry
+        # parallel workers match on the snapshot without building the graph
+        view = SnapshotGraph(snapshot)
+        for rule in (Rule.parse('(+ x 1)', '(+ 1 x)'), Rule.parse('(* (o x y) 2)', 'x'), Rule.parse('1.5', '2')):
+            assert len(match_rule(g, rule)) > 0
+            assert match_rule(view, rule) == match_rule(g, rule) == match_rule(view, rule, "relational")
+        assert view.lookup(ENode(Variable("missing"))) is None and view.classes_with_op(Variable("-"), 3) == set()
+        assert all(view.lookup(node) == g.find(c) for c in g.classes for node in g.classes[c])
+
+# RHS templates add the same e-nodes as building the RHS Ast, an operator symbol included,
+# also when the RHS uses that operator as a leaf
+for rule, example in ((Rule.parse('(g (o x y))', '(h o x)', custom_ops=['g', 'h']), "(g (* a b))"),
+                      (Rule.parse('(- (o x y))', '(+ (o y x) 0)'), "(- (* a 2))")):
+    print(rule.template.display)
+    a, b = EGraph.from_ast(parse(example)), EGraph.from_ast(parse(example))
+    for result in match_rule(a, rule):
+        a.apply_(result)
+    for rule_match in search_matches(b, rule):
+        b.apply_match_(rule_match)
+    a.rebuild()
+    b.rebuild()
+    assert a.registry == b.registry and a.classes == b.classes and a.n_nodes > 3
+
+# the relational backend joins on shared symbols and finds the same matches
+for rule in (Rule.parse('(- (o x y))', '(o y x)'), Rule.parse('(o x x)', 'x'), Rule.parse('(+ (* x 2) 0)', 'x')):
+    assert match_rule(g, rule, "relational") == match_rule(g, rule, "compiled")
+rule = Rule.parse('(+ (o y x) 0)', 'y')
+assert len(match_rule(a, rule, "relational")) == 1 and match_rule(a, rule, "relational") == match_rule(a, rule)
+
+# parent lists hold node ids, merges make congruent parents share one id after rebuild
+g = EGraph.empty()
+x, y, fx, fy = (g.add_expr(e) for e in ("x", "y", "(f x)", "(f y)"))
+g.add_expr("(g (f x) (f x))")
+assert [class_id for _, class_id in g.parent_nodes(fx)] == [g.find(g.roots[-1])]
+g.merge_class_(x, y)
+g.rebuild()
+assert g.find(fx) == g.find(fy) and len(g.parents[g.find(x)]) == 1
+assert {(l.source.id, l.content) for l in g.to_mermaid().links} == {(2, "0"), (3, "0"), (3, "1")}
+
+# the compact storage takes the same steps to the same graph
+rule = Rule.parse('(o x y)', '(o y x)')
+a, b = EGraph.empty(), CompactEGraph.empty()
+for g in (a, b):
+    g.add_exprs("(f x (g y z)) (g y z) (f x w) (g (f x w) (g z y))")
+    g.merge_class_(g.roots[1], g.roots[2])
+    g.merge_class_(g.class_of(ENode(parse("z"))), g.class_of(ENode(parse("w"))))
+    g.rebuild()
+    for rule_match in search_matches(g, rule):
+        g.apply_match_(rule_match)
+    g.rebuild()
+assert a.classes == b.classes and a.registry == b.registry and hash(a) == hash(b)
+assert a.n_nodes == b.n_nodes and a.take_dirty_() == b.take_dirty_()
+assert match_rule(b, rule, "relational") == match_rule(b, rule) == match_rule(a, rule)
+assert {c: set(a.parent_nodes(c)) for c in a.classes} == {c: set(b.parent_nodes(c)) for c in b.classes}
+print(b.to_mermaid().display())
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "g.egraph")
+    b.save(path)
+    assert EGraph.load(path).classes == a.classes
+    # the compact graph loads back as one and takes the same steps as the loaded EGraph
+    loaded, compact = EGraph.load(path), CompactEGraph.load(path)
+    assert type(loaded) is EGraph and type(compact) is CompactEGraph
+    assert compact.classes == a.classes and compact.registry == loaded.registry and hash(compact) == hash(loaded)
+    for graph in (loaded, compact):
+        graph.merge_class_(graph.add_expr("(f (g y z) w)"), graph.add_expr("w"))
+        graph.merge_class_(graph.add_expr("y"), graph.add_expr("z"))
+        graph.rebuild()
+    assert compact.classes == loaded.classes and compact.registry == loaded.registry and hash(compact) == hash(loaded)
+    assert {c: set(loaded.parent_nodes(c)) for c in loaded.classes} == \
+           {c: set(compact.parent_nodes(c)) for c in compact.classes}
+
+# incremental saturation reads the dirty classes, both graphs end in the same state
+ruleset = parse_ruleset("(* (+ x y) z) == (+ (* x z) (* y z))\n(* x y) == (* y x)\n(+ x y) == (+ y x)", trim=True)
+a, b, c = (cls.from_ast(parse("(* (+ a 2) b)")) for cls in (EGraph, CompactEGraph, CompactEGraph))
+for g in (a, b, c):
+    Runner(g, incremental=True).run(ruleset)
+assert a.classes == b.classes and hash(a) == hash(b) and b.dirty == set()
+assert b == c and b != CompactEGraph.from_ast(parse("(* (+ a 2) b)"))
@@ -1,33 +1,11 @@
 from __future__ import annotations
 
-from egraph import EGraph, AstP
-from equal_egraph import equal_ast
+from egraph import EGraph, AstP, ENode
+from equal_egraph import equal_ast, check_equalities
 from match_egraph import match_rule
 from mini_lisp.core import parse
-from mini_lisp.rules import RuleSet, parse_ruleset
-
-
-def saturate(egraph: EGraph, rule_set: RuleSet, visualize_lvl: int = 0, max_iter: int = 200) -> None:
-    iter_counter = 0
-    h = hash(egraph)
-    nh = None
-    while nh != h:
-        results = list(res for rule in rule_set for res in match_rule(egraph, rule))
-        if len(results) == 0:
-            break
-        for result in results:
-            old_h_in = hash(egraph)
-            egraph.apply_(result)
-            if hash(egraph) != old_h_in and visualize_lvl == 2:
-                egraph.to_mermaid().view_()
-        if hash(egraph) != old_h_in and visualize_lvl == 1:
-            egraph.to_mermaid().view_()
-        h = nh
-        nh = hash(egraph)
-        iter_counter += 1
-        if iter_counter > max_iter:
-            print("max_iter reached! ")
-            break
+from mini_lisp.rules import Rule, parse_ruleset
+from runner import saturate
 
 
 def check_equality(ast: AstP, egraph: EGraph):
@@ -54,3 +32,27 @@ if __name__ == "__main__":
     example2 = "(+ (* a b) (* 2 b))"
     assert check_equality(parse(example2), g)
     assert not check_equality(parse("(+ (* a b) (* 3 b))"), g)
+
+    # before rebuild the hashcons misses congruent terms, the memoized matcher still finds them
+    g = EGraph.from_ast(parse("(* (+ a 1) (+ b 1))"))
+    g.apply_(next(iter(match_rule(g, Rule.parse('a', 'b', custom_ops=['a', 'b'])))))
+    assert check_equality(parse("(* (+ a 1) (+ a 1))"), g)
+    g.rebuild()
+    assert check_equality(parse("(* (+ b 1) (+ a 1))"), g)
+    assert not check_equality(parse("(* (+ b 1) (+ a 2))"), g)
+
+    # batches share subterm lookups, the process pool gives the same answers
+    queries = ["(* (+ a 1) (+ b 1))", "(* (+ b 1) (+ a 1))", "(+ a 1)", "(* (+ b 1) (+ a 2))"]
+    results = check_equalities(g, queries)
+    assert [r.equal for r in results] == [True, True, False, False]
+    assert results[2].class_id is not None
+    assert results[3].class_id is None
+    assert check_equalities(g, queries, processes=2, chunk_size=1) == results
+
+    # before rebuild a hashcons hit can be a class congruent to the root but not merged with it yet
+    g = EGraph.from_ast(parse("(+ a b)"))
+    g.add_expr("(+ c b)")
+    g.merge_class_(g.lookup(ENode(parse("c"))), g.lookup(ENode(parse("a"))))
+    assert len(g.pending) > 0
+    assert check_equality(parse("(+ a b)"), g) and check_equality(parse("(+ c b)"), g)
+    assert [r.equal for r in check_equalities(g, ["(+ a b)", "(+ c b)", "(+ b c)"])] == [True, True, False]
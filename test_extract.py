@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+from egraph import EGraph
+from extract import extract, op_weights, ast_depth, Extractor
+from extract_dag import extract_dag, op_node_weights, DagExtractor
+from mini_lisp.core import parse
+from mini_lisp.rules import parse_ruleset
+from mini_lisp.tree_utils import tree_display_short
+from runner import Runner
+
+ruleset = parse_ruleset(
+    """
+    (/ (* x y) z) == (* x (/ y z))
+    (/ x x) == 1
+    (* x 1) -> x
+    (* x 2) == (<< x 1)
+    (* x y) == (* y x)
+    """, trim=True
+)
+
+g = EGraph.from_ast(parse("(/ (* (* a 2) 2) 2)"))
+Runner(g).run(ruleset)
+
+cost, best = extract(g)
+print(cost, tree_display_short(best))
+assert cost == 3 and best in {parse("(* a 2)"), parse("(* 2 a)"), parse("(<< a 1)")}
+
+cost, best = extract(g, op_weights({'*': 4, '<<': 1}))
+print(cost, tree_display_short(best))
+assert best is parse("(<< a 1)")
+
+# a cycle: after (* x 1) -> x, the class of a holds (* a 1) which refers back to it
+g = EGraph.from_ast(parse("(* a 1)"))
+Runner(g).run(ruleset)
+cost, best = extract(g, ast_depth)
+assert best is parse("a")
+assert Extractor(g).find_best_cost(g.root_class) == 1
+
+# DAG cost: (* A A) shares A, so it is cheaper than (* B C) once shared subterms are paid for once
+g = EGraph.from_ast(parse("(* (wigd x) (wigd x))"))
+g.merge_class_(g.root_class, EGraph.attach_ast_(parse("(* (b x) (c x))"), g))
+g.rebuild()
+weights = {'wigd': 3, 'b': 2, 'c': 2}
+cost, best = extract(g, op_weights(weights))
+print(cost, tree_display_short(best))
+assert best is parse("(* (b x) (c x))")
+result = extract_dag(g, op_node_weights(weights))
+print(result.cost, tree_display_short(result.term), result.gap)
+assert result.exact and result.cost == 5 and result.greedy_cost == 6 and result.gap == 1
+assert result.term is parse("(* (wigd x) (wigd x))")
+# local search gets there too
+result = extract_dag(g, op_node_weights(weights), exact_limit=0)
+assert not result.exact and result.cost == 5
+# only the classes reachable from the root count towards exact_limit
+unrelated = EGraph.attach_ast_(parse("(+ " + " ".join(f"u{i}" for i in range(100)) + ")"), g)
+g.rebuild()
+assert len(g.classes) > 100 and g.find(unrelated) != g.find(g.root_class)
+result = extract_dag(g, op_node_weights(weights))
+assert result.exact and result.cost == 5
+# branch and bound out of time: local search improves its best selection, the result is not exact
+result = DagExtractor(g, op_node_weights(weights), exact_share=0.0).find_best(g.root_class)
+assert not result.exact and result.cost == 5 and result.greedy_cost == 6
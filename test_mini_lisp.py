@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import copy
+import os
+import pickle
+import tempfile
 
-from mini_lisp.core import tokenize, parse_tokens, parse, Symbols, get_symbols
-from mini_lisp.core_types import Symbol, Variable
+from mini_lisp.core import tokenize, parse_tokens, parse, Symbols, get_symbols, ParseError
+from mini_lisp.core_types import Symbol, Variable, Number, interned_count
 from mini_lisp.patterns import PartialProgram, match
 from mini_lisp.program import FreeAst, Program, OrderedFreeAst
 from mini_lisp.rules import Rule, parse_ruleset
@@ -56,3 +60,45 @@ ruleset = parse_ruleset(
 
 print("\n--------\n".join(i.display for i in ruleset))
 print("\n".join(i.short_display for i in ruleset))
+
+#%%
+# interned nodes: structurally equal trees are the same object
+shared = parse("(+ (* a 2) (* a 2))")
+assert shared.args[1] is shared.args[2]
+assert parse("(+ (* a 2) (* a 2))") is shared
+assert tree_replace(shared, {Variable('a'): Variable('b')}, Variable, type(shared)) is parse("(+ (* b 2) (* b 2))")
+
+#%%
+# the parser is iterative, deep nesting does not hit the recursion limit, errors point at the source
+deep = parse("(- " * 50_000 + "x" + ")" * 50_000)
+assert deep.args[1].args[1].args[0] == Variable('-')
+assert parse_tokens(tokenize(example)) is parsed
+try:
+    parse("(+ a 1)\n  (* (+ b 2)")
+    assert False
+except ParseError as e:
+    print(e)
+    assert "line 2, column 3" in str(e)
+
+#%%
+# compiled rule sets are cached on disk by source hash
+with tempfile.TemporaryDirectory() as cache_dir:
+    rules_str = "(* x 2) == (<< x 1)\n(* x 1) -> x"
+    cached = parse_ruleset(rules_str, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    assert parse_ruleset(rules_str, cache_dir=cache_dir) == cached == parse_ruleset(rules_str)
+    parse_ruleset(rules_str, trim=True, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+#%%
+# the intern table holds nodes weakly: a tree leaves it when nothing else holds it,
+# an unpickled or copied node is the interned one
+before = interned_count()
+big = parse("(+ " + " ".join(str(i) for i in range(10_000_000, 10_001_000)) + ")")
+assert interned_count() >= before + 1001
+leaf = pickle.loads(pickle.dumps(big.args[1]))
+assert leaf is big.args[1] and copy.deepcopy(big) is big
+del big
+assert interned_count() == before + 1 and leaf is Number(10_000_000)
+# an int and a float are different numbers, unlike NamedTuples they are not equal
+assert Number(1) is not Number(1.0) and Number(1) != Number(1.0) and parse("1.0") is Number(1.0)
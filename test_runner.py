@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from egraph import EGraph
+from mini_lisp.core import parse
+from mini_lisp.rules import parse_ruleset
+from parallel_match import ParallelMatcher
+from runner import Runner, StopReason
+from scheduler import BackoffScheduler
+from test_equality import check_equality
+
+ruleset = parse_ruleset(
+    """
+    (* (+ x y) z) == (+ (* x z) (* y z))
+    (* x y) == (* y x)
+    (+ x y) == (+ y x)
+    """, trim=True
+)
+
+g = EGraph.from_ast(parse("(* (+ a 2) b)"))
+runner = Runner(g)
+assert runner.run(ruleset) == StopReason.Saturated
+[print(i) for i in runner.iterations]
+assert check_equality(parse("(+ (* b a) (* 2 b))"), g)
+
+g = EGraph.from_ast(parse("(* (+ a 2) b)"))
+assert Runner(g, iter_limit=1).run(ruleset) == StopReason.IterationLimit
+
+g = EGraph.from_ast(parse("(* (+ a 2) b)"))
+assert Runner(g, node_limit=8).run(ruleset) == StopReason.NodeLimit
+
+# limits are checked within an iteration: commuting every sum at once would add 255 nodes here
+g = EGraph.from_ast(parse(" ".join(f"(+ x{i}" for i in range(255)) + " x255" + ")" * 255))
+limit = g.n_nodes + 10
+runner = Runner(g, node_limit=limit)
+assert runner.run(ruleset) == StopReason.NodeLimit and len(runner.iterations) == 1
+assert limit < g.n_nodes <= limit + 2 and g.pending == []
+
+# backoff: commutativity gets banned, but the graph still saturates to the same classes
+g = EGraph.from_ast(parse("(* (+ a 2) b)"))
+scheduler = BackoffScheduler(match_limit=2, ban_length=1)
+assert Runner(g, scheduler=scheduler).run(ruleset) == StopReason.Saturated
+[print(rule, stats) for rule, stats in scheduler.stats.items()]
+assert any(stats.times_banned > 0 for stats in scheduler.stats.values())
+assert check_equality(parse("(+ (* b a) (* 2 b))"), g)
+
+# semi-naive: later iterations only search near changed classes, saturation is confirmed by a full pass
+g = EGraph.from_ast(parse("(+ (* (+ a 2) b) (* (+ c 3) (+ d 4)))"))
+full = EGraph.from_ast(parse("(+ (* (+ a 2) b) (* (+ c 3) (+ d 4)))"))
+runner = Runner(g, incremental=True)
+assert runner.run(ruleset) == Runner(full).run(ruleset) == StopReason.Saturated
+assert len(g.classes) == len(full.classes) and g.n_nodes == full.n_nodes
+assert not all(i.full_pass for i in runner.iterations) and runner.iterations[-1].full_pass
+assert check_equality(parse("(+ (+ (* b 2) (* a b)) (* (+ 3 c) (+ d 4)))"), g)
+
+if __name__ == "__main__":
+    # parallel matching reaches the same graph, and merges matches in the same order every run
+    fingerprints = set()
+    for _ in range(2):
+        g = EGraph.from_ast(parse("(* (+ a 2) b)"))
+        with ParallelMatcher(ruleset, processes=2, n_shards=3) as parallel:
+            assert Runner(g, parallel=parallel).run(ruleset) == StopReason.Saturated
+        assert len(g.classes) == 7
+        assert check_equality(parse("(+ (* b a) (* 2 b))"), g)
+        fingerprints.add(g.fingerprint)
+    assert len(fingerprints) == 1
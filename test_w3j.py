@@ -1,7 +1,7 @@
 from egraph import EGraph
 from mini_lisp.core import parse
 from mini_lisp.rules import parse_ruleset
-from test_equality import saturate
+from runner import saturate
 
 example = "(* (w3j l1 l2 l3 s1 s2 s3) (w3j l2 l1 l3 s2p s1p s3p))"
 g = EGraph.from_ast(parse(example))